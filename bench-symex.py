@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+
+## Micro-benchmarks for the concolic execution engine.
+##
+##   ./bench-symex.py [benchmark...]
+##
+## Without arguments, all benchmarks are run.  The "backends" benchmark
+## solves the queries stored in a solver cache file (see the "cachefile"
+## argument of concolic_test), named by $SYMEX_CORPUS, or a few queries
+## built from a zoobar path condition if there is no such file.
+
+import gc
+import os
+import resource
+import sys
+import time
+import symex.fuzzy as fuzzy
+import symex.solvercache as solvercache
+from symex.fuzzy import *
+
+def timeit(f, n):
+  start = time.time()
+  for i in xrange(n):
+    f()
+  return (time.time() - start) / n
+
+def zoobar_path_condition():
+  ## A path condition shaped like the ones check-symex-zoobar.py gets
+  ## for a logged-in transfer, along with values that satisfy it.
+  method = sym_str('method')
+  path = sym_concat(sym_str('path'), const_str('/'))
+  user = sym_str('user')
+  zoobars = sym_int('transfer.zoobars')
+  recipient = sym_str('transfer.recipient')
+  t = const_bool(True)
+  f = const_bool(False)
+  pc = sym_and(
+    sym_eq(sym_eq(method, const_str('get')), f),
+    sym_eq(sym_eq(method, const_str('post')), t),
+    sym_eq(sym_eq(sym_substring(path, const_int(0), const_int(1)),
+                  const_str('/')), f),
+    sym_eq(sym_eq(path, const_str('transfer/')), t),
+    sym_eq(sym_eq(user, const_str('alice')), t),
+    sym_eq(sym_lt(zoobars, const_int(0)), f),
+    sym_eq(sym_gt(zoobars, const_int(10)), f),
+    sym_eq(sym_eq(recipient, const_str('bob')), t),
+    sym_eq(sym_contains(recipient, const_str(' ')), f),
+  )
+  values = {
+    'method': 'post',
+    'path': 'transfer',
+    'user': 'alice',
+    'transfer.zoobars': 5,
+    'transfer.recipient': 'bob',
+  }
+  return (pc, values)
+
+def bench_eval():
+  ## Checking a model with the compiled evaluator, against asking Z3.
+  (pc, values) = zoobar_path_condition()
+  assert satisfies(pc, values)
+  t_eval = timeit(lambda: satisfies(pc, values), 10000)
+  t_z3 = timeit(lambda: fork_and_check(pc), 20)
+  print 'eval: compiled evaluator %.1f us per check' % (t_eval * 1e6)
+  print 'eval: Z3 round trip %.1f us per check' % (t_z3 * 1e6)
+  print 'eval: %.0fx faster' % (t_z3 / t_eval)
+
+def bench_simplify():
+  ## simplify() on the branches of a path, as add_constr() calls it:
+  ## once on nodes it has not seen, and again on the same nodes.
+  (pc, values) = zoobar_path_condition()
+  def cold():
+    fuzzy.simplify_cache.clear()
+    for c in pc.args:
+      simplify(c)
+  def warm():
+    for c in pc.args:
+      simplify(c)
+  t_cold = timeit(cold, 2000)
+  t_warm = timeit(warm, 20000)
+  print 'simplify: %.1f us per path, %.1f us per path seen before' % \
+        (t_cold * 1e6, t_warm * 1e6)
+
+def bench_branches():
+  ## Concolic branches per second, taken 30 frames deep into the stack,
+  ## about as deep as a Django view runs.
+  def nest(depth, f):
+    if depth == 0:
+      return f()
+    return nest(depth - 1, f)
+  def branches():
+    x = mk_int('x')
+    for i in xrange(10):
+      if x == i:
+        pass
+  def run():
+    fuzzy.cur_path_constr = []
+    fuzzy.cur_path_constr_callers = []
+    nest(30, branches)
+  fuzzy.concrete_values = {}
+  t = timeit(run, 1000)
+  print 'branches: %.0f branches per second' % (10 / t)
+
+def rss():
+  ## Resident set size of this process, in bytes (Linux only).
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * resource.getpagesize()
+
+def bench_memory():
+  ## Memory held by each concolic value derived from an input, not
+  ## counting its symbolic expression, which all of them share here.
+  fuzzy.concrete_values = {}
+  fuzzy.cur_path_constr = []
+  fuzzy.cur_path_constr_callers = []
+  x = mk_int('x')
+  s = mk_str('s')
+  n = 100000
+  for (name, f) in [('int', lambda i: x + 1), ('str', lambda i: s + 'a')]:
+    gc.collect()
+    before = rss()
+    values = [f(i) for i in xrange(n)]
+    print 'memory: %.0f bytes per concolic %s' % \
+          (float(rss() - before) / n, name)
+    del values
+
+def query_corpus():
+  path = os.environ.get('SYMEX_CORPUS', 'symex-cache.db')
+  if os.path.exists(path):
+    cache = solvercache.SolverCache(path)
+    queries = list(cache.queries())
+    cache.close()
+    return queries
+  (pc, values) = zoobar_path_condition()
+  return [sym_and(*pc.args[:i]) for i in range(1, len(pc.args) + 1)]
+
+def bench_backends():
+  ## Solve times of each solver backend on the same queries.
+  queries = query_corpus()
+  answers = {}
+  for backend in sorted(fuzzy.solver_backends):
+    fuzzy.solver_backend = backend
+    counts = {}
+    start = time.time()
+    for query in queries:
+      (ok, model) = fork_and_check(query, fuzzy.z3_timeout)
+      counts[str(ok)] = counts.get(str(ok), 0) + 1
+      answers.setdefault(query, {})[backend] = str(ok)
+    t = time.time() - start
+    print 'backends: %s %.1f ms per query (%s)' % \
+          (backend, t * 1000 / len(queries),
+           ', '.join('%d %s' % (counts[k], k) for k in sorted(counts)))
+  disagree = [q for q in answers
+              if 'unknown' not in answers[q].values() and
+                 len(set(answers[q].values())) > 1]
+  print 'backends: %d queries, %d with different answers' % \
+        (len(queries), len(disagree))
+
+benchmarks = [
+  ('eval', bench_eval),
+  ('simplify', bench_simplify),
+  ('branches', bench_branches),
+  ('memory', bench_memory),
+  ('backends', bench_backends),
+]
+
+if __name__ == '__main__':
+  names = sys.argv[1:] or [name for (name, _) in benchmarks]
+  for (name, f) in benchmarks:
+    if name in names:
+      f()
@@ -7,6 +7,9 @@
 # 3 = branch stacks, response bodies
 verbose = 1
 
+# Number of processes running requests side by side
+nprocs = 1
+
 import os
 import re
 import symex.fuzzy as fuzzy
@@ -63,8 +66,29 @@ def adduser(username):
   u.save()
   return u
 
-# TODO(jon): This currently only test single-request actions
+# Fixtures are created once; every iteration starts from them, and its
+# changes to the database are rolled back when it ends.
+def create_fixtures():
+  from django.contrib.auth.models import User
+  from zapp.models import Transfer
+  User.objects.all().delete()
+  Transfer.objects.all().delete()
+  adduser('alice')
+  adduser('bob')
+
+def setup_stuff():
+  d.load_fixtures(create_fixtures)
+
+# Each process running requests works on a copy of the database.
+def worker_db():
+  d.private_db(os.getpid())
+
 def test_stuff():
+  with d.clean_db():
+    test_request()
+
+# TODO(jon): This currently only test single-request actions
+def test_request():
   method = fuzzy.mk_str('method')
   if not method == 'get' and not method == 'post':
     return
@@ -72,13 +96,7 @@ def test_stuff():
   req = d.new()
 
   from django.contrib.auth.models import User
-  User.objects.all().delete()
-  alice = adduser('alice')
-  bob = adduser('bob')
   balance1 = sum([u.person.zoobars for u in User.objects.all()])
-
-  from zapp.models import Transfer
-  Transfer.objects.all().delete()
   #User.objects.get(username = 'alice')
 
   ## In two cases, we over-restrict the inputs in order to reduce the
@@ -179,10 +197,16 @@ def test_stuff():
         # outside the scope of the exercise?
 
 start = time.time()
+# Coverage data is collected in this process, so iterations only run in
+# forked children, or in several processes at once, without it.
 fuzzy.concolic_test(test_stuff, maxiter=2000, v=verbose,
                     uniqueinputs = True,
                     removeredundant = True,
-                    usecexcache = True)
+                    usecexcache = True,
+                    setup = setup_stuff,
+                    forkserver = cov is None,
+                    testprocs = nprocs if cov is None else 1,
+                    testinit = worker_db)
 end = time.time()
 print "%.2f seconds" %(end-start)
 
@@ -1,37 +1,87 @@
-import z3str
+try:
+  import z3str
+except ImportError:
+  ## Only the "z3" solver backend works without the z3str submodule.
+  z3str = None
 import z3
-import multiprocessing
+import os
 import sys
+import re
 import collections
-import Queue
-import signal
-import operator
-import inspect
+import heapq
+import itertools
 import __builtin__
+import atexit
+import hashlib
+import time
+import traceback
+import cPickle
+import zlib
+import solverpool
+import remotepool
+import solvercache
+import weakref
 
 ## Our AST structure
 
+class sym_ast_type(type):
+  ## Metaclass of all AST nodes.  Node classes get __slots__, so nodes
+  ## carry no __dict__, and nodes are hash-consed: constructing a node
+  ## that is structurally identical to a live one returns the existing
+  ## object.  Since arguments are themselves interned, looking a node
+  ## up only hashes and compares its immediate arguments.
+  interned = weakref.WeakValueDictionary()
+
+  def __new__(mcls, name, bases, d):
+    d.setdefault('__slots__', ())
+    return type.__new__(mcls, name, bases, d)
+
+  def __call__(cls, *args):
+    key = (cls, args)
+    try:
+      node = sym_ast_type.interned.get(key)
+    except TypeError:
+      ## Unhashable arguments; let __init__ complain about them.
+      return type.__call__(cls, *args)
+    if node is None:
+      node = type.__call__(cls, *args)
+      object.__setattr__(node, '_hash', hash(key))
+      sym_ast_type.interned[key] = node
+    return node
+
 class sym_ast(object):
+  ## Nodes are immutable, so that interned nodes can be shared freely;
+  ## equality is identity, and the hash is computed once.
+  __metaclass__ = sym_ast_type
+  __slots__ = ('_hash', '__weakref__')
+
   def __str__(self):
     return str(self._z3expr(True))
 
+  def __setattr__(self, name, value):
+    raise AttributeError("AST nodes are immutable")
+
+  def __eq__(self, o):
+    return self is o
+
+  def __ne__(self, o):
+    return self is not o
+
+  def __hash__(self):
+    return self._hash
+
 class sym_func_apply(sym_ast):
+  __slots__ = ('args',)
+
   def __init__(self, *args):
     for a in args:
       if not isinstance(a, sym_ast):
         raise Exception("Passing a non-AST node %s %s as argument to %s" % \
                         (a, type(a), type(self)))
-    self.args = args
+    object.__setattr__(self, 'args', args)
 
-  def __eq__(self, o):
-    if type(self) != type(o):
-      return False
-    if len(self.args) != len(o.args):
-      return False
-    return all(sa == oa for (sa, oa) in zip(self.args, o.args))
-
-  def __hash__(self):
-    return reduce(operator.xor, [hash(a) for a in self.args], 0)
+  def __reduce__(self):
+    return (type(self), self.args)
 
 class sym_unop(sym_func_apply):
   def __init__(self, a):
@@ -69,71 +119,129 @@ class sym_triop(sym_func_apply):
   def c(self):
     return self.args[2]
 
+## Translations of AST nodes into Z3 terms are memoized per process.
+## Nodes are interned, so a subtree shared by many queries, such as a
+## path prefix or an encoded string constant, is translated only once
+## by each solver process.  Terms are specific to the solver backend
+## they were built for, so the backend is part of the key.  "z3expr_stats"
+## counts cache hits and misses since the counters were last collected.
+z3expr_cache = {}
+z3expr_cache_max = 100000
+z3expr_stats = {'hits': 0, 'misses': 0}
+
 def z3expr(o, printable = False):
   assert isinstance(o, sym_ast)
-  return o._z3expr(printable)
+  key = (o, printable, solver_backend)
+  e = z3expr_cache.get(key)
+  if e is not None:
+    z3expr_stats['hits'] += 1
+    return e
+
+  z3expr_stats['misses'] += 1
+  e = o._z3expr(printable)
+  if len(z3expr_cache) >= z3expr_cache_max:
+    z3expr_cache.clear()
+  z3expr_cache[key] = e
+  return e
 
-class const_str(sym_ast):
-  def __init__(self, v):
-    self.v = v
+def collect_z3expr_stats():
+  stats = dict(z3expr_stats)
+  for k in z3expr_stats:
+    z3expr_stats[k] = 0
+  return stats
 
-  def __eq__(self, o):
-    if not isinstance(o, const_str):
-      return False
-    return self.v == o.v
+## Concrete evaluation.  Each node compiles into a Python closure that
+## computes its value under an assignment of values to symbolic variable
+## names, with the same defaults as mk_int() and mk_str().  This lets us
+## check a candidate model without a solver round trip.  Operations that
+## z3str leaves unspecified, such as out-of-range substrings, raise
+## EvalUndefined.
 
-  def __ne__(self, o):
-    return not self.__eq__(o)
+class EvalUndefined(Exception):
+  pass
 
-  def __hash__(self):
-    return hash(self.v)
+compiled_cache = weakref.WeakKeyDictionary()
+
+def compile_ast(o):
+  f = compiled_cache.get(o)
+  if f is None:
+    f = o._compile()
+    compiled_cache[o] = f
+  return f
+
+def compile_args(o):
+  return [compile_ast(a) for a in o.args]
+
+def evaluate(o, values):
+  return compile_ast(o)(values)
+
+def satisfies(o, values):
+  try:
+    return bool(evaluate(o, values))
+  except EvalUndefined:
+    return False
+
+def z3_div(a, b):
+  ## Z3 integer division rounds so that the remainder is non-negative.
+  if b == 0:
+    raise EvalUndefined()
+  if b > 0:
+    return a // b
+  return -(a // -b)
+
+def z3str_substring(s, start, length):
+  if start < 0 or length < 0 or start + length > len(s):
+    raise EvalUndefined()
+  return s[start:start + length]
+
+class const_str(sym_ast):
+  __slots__ = ('v',)
+
+  def __init__(self, v):
+    object.__setattr__(self, 'v', v)
+
+  def __reduce__(self):
+    return (type(self), (self.v,))
 
   def _z3expr(self, printable):
-    ## z3str has a weird way of encoding string constants.
-    ## for printing, we make strings look like nice constants,
-    ## but otherwise we use z3str's encoding plan.
-    if printable:
-      return z3.Const('"%s"' % self.v, z3str.StringSort())
+    return get_backend().StringVal(self.v, printable)
 
-    enc = "__cOnStStR_" + "".join(["_x%02x" % ord(c) for c in self.v])
-    return z3.Const(enc, z3str.StringSort())
+  def _compile(self):
+    v = self.v
+    return lambda values: v
 
 class const_int(sym_ast):
-  def __init__(self, i):
-    self.i = i
-
-  def __eq__(self, o):
-    if not isinstance(o, const_int):
-      return False
-    return self.i == o.i
+  __slots__ = ('i',)
 
-  def __ne__(self, o):
-    return not self.__eq__(o)
+  def __init__(self, i):
+    object.__setattr__(self, 'i', i)
 
-  def __hash__(self):
-    return hash(self.i)
+  def __reduce__(self):
+    return (type(self), (self.i,))
 
   def _z3expr(self, printable):
     return self.i
 
-class const_bool(sym_ast):
-  def __init__(self, b):
-    self.b = b
+  def _compile(self):
+    i = self.i
+    return lambda values: i
 
-  def __eq__(self, o):
-    if not isinstance(o, const_bool):
-      return False
-    return self.b == o.b
+class const_bool(sym_ast):
+  __slots__ = ('b',)
 
-  def __ne__(self, o):
-    return not self.__eq__(o)
+  def __init__(self, b):
+    object.__setattr__(self, 'b', b)
 
-  def __hash__(self):
-    return hash(self.b)
+  def __reduce__(self):
+    return (type(self), (self.b,))
 
   def _z3expr(self, printable):
     return self.b
 
+  def _compile(self):
+    b = self.b
+    return lambda values: b
+
 def ast(o):
   if hasattr(o, '_sym_ast'):
     return o._sym_ast()
@@ -151,131 +259,218 @@ class sym_eq(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) == z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) == b(values)
+
 class sym_and(sym_func_apply):
   def _z3expr(self, printable):
     return z3.And(*[z3expr(a, printable) for a in self.args])
 
+  def _compile(self):
+    args = compile_args(self)
+    return lambda values: all(a(values) for a in args)
+
 class sym_or(sym_func_apply):
   def _z3expr(self, printable):
     return z3.Or(*[z3expr(a, printable) for a in self.args])
 
+  def _compile(self):
+    args = compile_args(self)
+    return lambda values: any(a(values) for a in args)
+
 class sym_not(sym_unop):
   def _z3expr(self, printable):
     return z3.Not(z3expr(self.a, printable))
 
+  def _compile(self):
+    (a,) = compile_args(self)
+    return lambda values: not a(values)
+
 ## Arithmetic
 
 class sym_int(sym_ast):
+  __slots__ = ('id',)
+
   def __init__(self, id):
-    self.id = id
+    object.__setattr__(self, 'id', id)
 
-  def __eq__(self, o):
-    if not isinstance(o, sym_int):
-      return False
-    return self.id == o.id
-
-  def __hash__(self):
-    return hash(self.id)
+  def __reduce__(self):
+    return (type(self), (self.id,))
 
   def _z3expr(self, printable):
     return z3.Int(self.id)
 
+  def _compile(self):
+    id = self.id
+    return lambda values: values.get(id, 0)
+
 class sym_lt(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) < z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) < b(values)
+
 class sym_lte(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) <= z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) <= b(values)
+
 class sym_gt(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) > z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) > b(values)
+
 class sym_gte(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) >= z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) >= b(values)
+
 class sym_plus(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) + z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) + b(values)
+
 class sym_minus(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) - z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) - b(values)
+
 class sym_mul(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) * z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) * b(values)
+
 class sym_div(sym_binop):
   def _z3expr(self, printable):
     return z3expr(self.a, printable) / z3expr(self.b, printable)
 
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: z3_div(a(values), b(values))
+
 ## String operations
 
 class sym_str(sym_ast):
+  __slots__ = ('id',)
+
   def __init__(self, id):
-    self.id = id
+    object.__setattr__(self, 'id', id)
 
-  def __eq__(self, o):
-    if not isinstance(o, sym_str):
-      return False
-    return self.id == o.id
-
-  def __hash__(self):
-    return hash(self.id)
+  def __reduce__(self):
+    return (type(self), (self.id,))
 
   def _z3expr(self, printable):
-    return z3.Const(self.id, z3str.StringSort())
+    return get_backend().String(self.id)
+
+  def _compile(self):
+    id = self.id
+    return lambda values: values.get(id, '')
 
 class sym_concat(sym_binop):
   def _z3expr(self, printable):
-    return z3str.Concat(z3expr(self.a, printable),
-                        z3expr(self.b, printable))
+    return get_backend().Concat(z3expr(self.a, printable),
+                                z3expr(self.b, printable))
+
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values) + b(values)
 
 class sym_length(sym_unop):
   def _z3expr(self, printable):
-    return z3str.Length(z3expr(self.a, printable))
+    return get_backend().Length(z3expr(self.a, printable))
+
+  def _compile(self):
+    (a,) = compile_args(self)
+    return lambda values: len(a(values))
 
 class sym_substring(sym_triop):
   def _z3expr(self, printable):
-    return z3str.SubString(z3expr(self.a, printable),
-                           z3expr(self.b, printable),
-                           z3expr(self.c, printable))
+    return get_backend().SubString(z3expr(self.a, printable),
+                                   z3expr(self.b, printable),
+                                   z3expr(self.c, printable))
+
+  def _compile(self):
+    (a, b, c) = compile_args(self)
+    return lambda values: z3str_substring(a(values), b(values), c(values))
 
 class sym_indexof(sym_binop):
   def _z3expr(self, printable):
-    return z3str.Indexof(z3expr(self.a, printable),
-                         z3expr(self.b, printable))
+    return get_backend().Indexof(z3expr(self.a, printable),
+                                 z3expr(self.b, printable))
+
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values).find(b(values))
 
 class sym_contains(sym_binop):
   def _z3expr(self, printable):
-    return z3str.Contains(z3expr(self.a, printable),
-                          z3expr(self.b, printable))
+    return get_backend().Contains(z3expr(self.a, printable),
+                                  z3expr(self.b, printable))
+
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: b(values) in a(values)
 
 class sym_startswith(sym_binop):
   def _z3expr(self, printable):
-    return z3str.StartsWith(z3expr(self.a, printable),
-                            z3expr(self.b, printable))
+    return get_backend().StartsWith(z3expr(self.a, printable),
+                                    z3expr(self.b, printable))
+
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values).startswith(b(values))
 
 class sym_endswith(sym_binop):
   def _z3expr(self, printable):
-    return z3str.EndsWith(z3expr(self.a, printable),
-                          z3expr(self.b, printable))
+    return get_backend().EndsWith(z3expr(self.a, printable),
+                                  z3expr(self.b, printable))
+
+  def _compile(self):
+    (a, b) = compile_args(self)
+    return lambda values: a(values).endswith(b(values))
 
 class sym_replace(sym_triop):
   def _z3expr(self, printable):
-    return z3str.Replace(z3expr(self.a, printable),
-                         z3expr(self.b, printable),
-                         z3expr(self.c, printable))
+    return get_backend().Replace(z3expr(self.a, printable),
+                                 z3expr(self.b, printable),
+                                 z3expr(self.c, printable))
+
+  def _compile(self):
+    (a, b, c) = compile_args(self)
+    return lambda values: a(values).replace(b(values), c(values), 1)
 
 ## Symbolic simplifications
 
 class patname(sym_ast):
+  __slots__ = ('name', 'pattern')
+
   def __init__(self, name, pattern = None):
-    self.name = name
-    self.pattern = pattern
+    object.__setattr__(self, 'name', name)
+    object.__setattr__(self, 'pattern', pattern)
+
+  def __reduce__(self):
+    return (type(self), (self.name, self.pattern))
 
 simplify_patterns_strings = [
   (sym_substring(patname("a",
@@ -331,7 +526,10 @@ simplify_patterns_arithmetic = [
 simplify_patterns = []
 simplify_patterns += simplify_patterns_strings
 simplify_patterns += simplify_patterns_logic
-# simplify_patterns += simplify_patterns_arithmetic
+simplify_patterns += simplify_patterns_arithmetic
+
+## whether to replace operations on constants with their result.
+simplify_constants = True
 
 def pattern_match(expr, pat, vars):
   if isinstance(pat, patname):
@@ -363,44 +561,207 @@ def pattern_build(pat, vars):
     return type(pat)(*args)
   return pat
 
-def simplify(e):
-  matched = True
-  while matched:
-    matched = False
-    for (src, dst) in simplify_patterns:
+def index_patterns(patterns):
+  ## Group rules by the node type at the head of their pattern, so that
+  ## a node is only matched against the rules that can apply to it.
+  ## Rules whose pattern is a bare name are filed under None.
+  index = {}
+  for (src, dst) in patterns:
+    head = src
+    while isinstance(head, patname) and head.pattern is not None:
+      head = head.pattern
+    if isinstance(head, patname):
+      key = None
+    else:
+      key = type(head)
+    index.setdefault(key, []).append((src, dst))
+  return index
+
+## simplify_patterns by head node type, and the simplified form of
+## each node that simplify() has seen, or None if it had none.  Both
+## need rebuilding if simplify_patterns changes.
+simplify_index = index_patterns(simplify_patterns)
+simplify_cache = weakref.WeakKeyDictionary()
+
+def rewrite(e):
+  ## The result of the first rule that applies to e itself, or e.
+  for rules in (simplify_index.get(type(e), ()),
+                simplify_index.get(None, ())):
+    for (src, dst) in rules:
       vars = {}
-      if not pattern_match(e, src, vars):
-        continue
-      e = pattern_build(dst, vars)
-      matched = True
+      if pattern_match(e, src, vars):
+        return pattern_build(dst, vars)
+  return e
 
+def fold_constants(e):
+  for a in e.args:
+    if not isinstance(a, (const_int, const_bool, const_str)):
+      return e
+  try:
+    return ast(evaluate(e, {}))
+  except EvalUndefined:
+    return e
+
+def simplify(e):
+  ## Simplify the arguments of e, then rewrite e until no rule applies.
+  ## Nodes that nothing applies to are returned as they are.
+  if not isinstance(e, sym_func_apply) and None not in simplify_index:
+    return e
+  try:
+    s = simplify_cache[e]
+    if s is None:
+      return e
+    return s
+  except KeyError:
+    pass
+
+  s = e
   if isinstance(e, sym_func_apply):
-    t = type(e)
-    args = [simplify(a) for a in e.args]
-    return t(*args)
+    args = tuple([simplify(a) for a in e.args])
+    if args != e.args:
+      s = type(e)(*args)
+    if simplify_constants:
+      s = fold_constants(s)
+  r = rewrite(s)
+  if r is not s:
+    s = simplify(r)
+
+  if s is e:
+    simplify_cache[e] = None
+  else:
+    simplify_cache[e] = s
+  return s
+
+## Canonical form of path conditions, used to key the persistent
+## solver cache.  Conjunctions and disjunctions are sorted, so the
+## order in which branches were taken does not change the key.
+
+canonical_cache = weakref.WeakKeyDictionary()
+
+def canonical(e):
+  s = canonical_cache.get(e)
+  if s is not None:
+    return s
 
-  return e
+  if isinstance(e, sym_func_apply):
+    args = [canonical(a) for a in e.args]
+    if isinstance(e, sym_and) or isinstance(e, sym_or):
+      args = sorted(set(args))
+    s = '(%s %s)' % (type(e).__name__, ' '.join(args))
+  elif isinstance(e, const_str):
+    v = e.v
+    if isinstance(v, unicode):
+      v = v.encode('utf-8')
+    s = repr(v)
+  elif isinstance(e, const_int):
+    s = str(e.i)
+  elif isinstance(e, const_bool):
+    s = str(e.b)
+  elif isinstance(e, sym_int):
+    s = 'int:' + repr(e.id)
+  elif isinstance(e, sym_str):
+    s = 'str:' + repr(e.id)
+  else:
+    raise Exception("No canonical form for %s %s" % (e, type(e)))
+
+  canonical_cache[e] = s
+  return s
+
+def cache_key(e):
+  ## Backends may disagree on corner cases, so each has its own results.
+  return hashlib.sha1(solver_backend + ':' + canonical(e)).hexdigest()
+
+## Constraint independence: conjuncts of a path condition that share
+## no symbolic variables with a branch cannot affect whether it can be
+## flipped.
+
+symvars_cache = weakref.WeakKeyDictionary()
+
+def symvars(e):
+  ## The names of the symbolic variables that e refers to.
+  vs = symvars_cache.get(e)
+  if vs is None:
+    if isinstance(e, sym_int) or isinstance(e, sym_str):
+      vs = frozenset([e.id])
+    elif isinstance(e, sym_func_apply):
+      vs = frozenset().union(*[symvars(a) for a in e.args])
+    else:
+      vs = frozenset()
+    symvars_cache[e] = vs
+  return vs
+
+nodecount_cache = weakref.WeakKeyDictionary()
+
+def nodecount(e):
+  ## The size of e as a tree, counting shared subtrees every time.
+  n = nodecount_cache.get(e)
+  if n is None:
+    n = 1
+    if isinstance(e, sym_func_apply):
+      n += sum(nodecount(a) for a in e.args)
+    nodecount_cache[e] = n
+  return n
+
+def independent_slice(conjuncts):
+  ## Return the conjuncts connected to the last one (the flipped branch)
+  ## through shared variables, in their original order.  Variables are
+  ## grouped with a union-find over the variables of each conjunct.
+  parent = {}
+  def find(v):
+    while parent[v] != v:
+      parent[v] = parent[parent[v]]
+      v = parent[v]
+    return v
+
+  for c in conjuncts:
+    vs = list(symvars(c))
+    for v in vs:
+      parent.setdefault(v, v)
+    for v in vs[1:]:
+      parent[find(v)] = find(vs[0])
+
+  branchvars = symvars(conjuncts[-1])
+  if len(branchvars) == 0:
+    return conjuncts[-1:]
+  root = find(iter(branchvars).next())
+  return [c for c in conjuncts
+          if len(symvars(c)) > 0 and find(iter(symvars(c)).next()) == root]
 
 ## Current path constraint
 
 cur_path_constr = None
 cur_path_constr_callers = None
 
+## A branch's caller is the list of (filename, lineno) pairs of the
+## stack frames it was taken in, innermost first.  Unless caller_stacks
+## is set, only the innermost frame is recorded, which is all that
+## InputQueue needs; the rest is only printed with verbose output.
+caller_stacks = False
+
+## whether stack frames of each source file belong to the engine.
+engine_files = {}
+
 def get_caller():
-  frame = inspect.currentframe()
+  frame = sys._getframe(1)
   back = []
   try:
-    while True:
-      info = inspect.getframeinfo(frame)
-      ## Skip stack frames inside the symbolic execution engine,
-      ## as well as in the rewritten replacements of dict, %, etc.
-      if not info.filename.endswith('fuzzy.py') and\
-         not info.filename.endswith('rewriter.py'):
-        back.append((info.filename, info.lineno))
+    while frame is not None:
+      filename = frame.f_code.co_filename
+      skip = engine_files.get(filename)
+      if skip is None:
+        ## Skip stack frames inside the symbolic execution engine,
+        ## as well as in the rewritten replacements of dict, %, etc.
+        skip = filename.endswith('fuzzy.py') or \
+               filename.endswith('rewriter.py')
+        engine_files[filename] = skip
+      if not skip:
+        back.append((filename, frame.f_lineno))
+        if not caller_stacks:
+          break
       frame = frame.f_back
   finally:
     del frame
-    return back
+  return back
 
 def add_constr(e):
   global cur_path_constr, cur_path_constr_callers
@@ -430,62 +791,564 @@ def uniqname(id):
 def indent(s, spaces = '\t'):
   return spaces + str(s).replace('\n', ' ')
 
-## Support for forking because z3str uses lots of global variables
+## Support for a pool of solver processes because z3str uses lots of
+## global variables
 
-## timeout for Z3, in seconds
+## timeout for Z3, in seconds; SolverTimeouts gives easy queries less
 z3_timeout = 5
 
-def fork_and_check_worker(constr, conn):
-  z3e = z3expr(constr)
-  (ok, z3m) = z3str.check_and_model(z3e)
+## number of long-lived solver processes, and how many queries each
+## of them answers before being replaced with a fresh process.  The
+## bound is large so that z3expr() translations stay cached, and only
+## holds for backends that leave no state behind; z3str processes are
+## replaced after every query (see Z3strBackend).  With more than one
+## process, concolic_test() solves all the branches of an iteration
+## concurrently.
+solver_nworkers = 1
+solver_maxqueries = 1000
+
+## which entry of solver_backends to translate and solve queries with.
+solver_backend = 'z3str'
+
+## Conjunct i of a query is tracked under the name track_prefix + i.
+## Symbolic variables are never Bool-sorted, so the tracking literals,
+## which Z3 includes in models, cannot be mistaken for one of them.
+track_prefix = '__track_c'
+
+def z3model(ok, z3m):
   m = {}
   if ok == z3.sat:
+    backend = get_backend()
     for k in z3m:
       v = z3m[k]
+      if v.sort() == z3.BoolSort():
+        continue
       if v.sort() == z3.IntSort():
         m[str(k)] = v.as_long()
-      elif v.sort() == z3str.StringSort():
+      elif v.sort() == backend.StringSort():
         # print "Model string %s: %s" % (k, v)
-        vs = str(v)
-        if not vs.startswith('__cOnStStR_'):
-          if not str(k).startswith('_t_'):
-            print 'Undecodable string constant (%s): %s' % (k, vs)
-          continue
-        hexbytes = vs.split('_x')[1:]
-        bytes = [int(h, 16) for h in hexbytes]
-        m[str(k)] = ''.join(chr(x) for x in bytes)
+        vs = backend.decode(k, v)
+        if vs is not None:
+          m[str(k)] = vs
       else:
         raise Exception("Unknown sort for %s=%s: %s" % (k, v, v.sort()))
-  conn.send((ok, m))
-  conn.close()
+  return (ok, m)
+
+def conjuncts_of(e):
+  if isinstance(e, sym_and):
+    return e.args
+  return (e,)
+
+def z3result(solver, ok, z3m):
+  ## Like z3model(), but if ok is unsat, the model is replaced with the
+  ## indices of the conjuncts in an unsat core, or None if the solver
+  ## gives no cores.
+  if ok == z3.unsat:
+    core = solver.core()
+    if core is not None:
+      core = sorted(int(name[len(track_prefix):]) for name in core)
+    return (ok, core)
+  return z3model(ok, z3m)
+
+def z3check(constr, params = ()):
+  solver = get_backend().solver(params)
+  for (i, c) in enumerate(conjuncts_of(constr)):
+    solver.add(z3expr(c), track_prefix + str(i))
+  return z3result(solver, *solver.check_and_model())
+
+class OneShotSolver(object):
+  ## push/pop/add on top of z3str's one-shot check_and_model(), so that
+  ## a PathSession can drive it like an incremental solver.  Only the
+  ## translated Z3 terms are kept from one check to the next.
+  def __init__(self):
+    self.scopes = [[]]
+
+  def push(self):
+    self.scopes.append([])
+
+  def pop(self):
+    self.scopes.pop()
+
+  def add(self, e, track = None):
+    self.scopes[-1].append(e)
+
+  def check_and_model(self):
+    return z3str.check_and_model(z3.And(*[e for s in self.scopes for e in s]))
+
+  def core(self):
+    ## z3str cannot tell which assertions made a query unsat.
+    return None
+
+class Z3Solver(object):
+  ## A native, incremental Z3 solver with the same interface.  "params"
+  ## are (name, value) pairs of Z3 solver parameters, such as
+  ## random_seed; a "tactic" parameter builds the solver from that
+  ## tactic instead of the default one.
+  def __init__(self, params = ()):
+    params = dict(params)
+    tactic = params.pop('tactic', None)
+    if tactic is not None:
+      self.s = z3.Tactic(tactic).solver()
+    else:
+      self.s = z3.Solver()
+    for (k, v) in sorted(params.items()):
+      self.s.set(k, v)
+    try:
+      self.s.set('core.minimize', True)
+    except z3.Z3Exception:
+      ## Z3 before 4.8 has no core minimization.
+      pass
 
-def fork_and_check(constr):
-  constr = simplify(constr)
+  def push(self):
+    self.s.push()
 
-  parent_conn, child_conn = multiprocessing.Pipe()
-  p = multiprocessing.Process(target=fork_and_check_worker,
-                              args=(constr, child_conn))
-  p.start()
-  child_conn.close()
+  def pop(self):
+    self.s.pop()
 
-  ## timeout after a while..
-  def sighandler(signo, stack):
-    print "Timed out.."
-    # print z3expr(constr, True).sexpr()
-    p.terminate()
+  def add(self, e, track = None):
+    ## Assertions added with a "track" name can show up in core().
+    if track is None:
+      self.s.add(e)
+    else:
+      self.s.assert_and_track(e, z3.Bool(track))
+
+  def check_and_model(self):
+    ok = self.s.check()
+    if ok == z3.sat:
+      return (ok, self.s.model())
+    return (ok, None)
+
+  def core(self):
+    ## The track names of the assertions in the last unsat core.
+    return [str(b) for b in self.s.unsat_core()]
+
+## Solver backends.  A backend builds the Z3 terms for strings and
+## string operations, decodes strings in models, and makes the solvers
+## that queries are checked with.
+
+class Z3strBackend(object):
+  ## The patched z3str submodule (see z3str.patch).  Every check is a
+  ## separate z3str run, which leaves state behind in global variables.
+  ## z3str has no way to clear them, so a solver process answers only
+  ## one z3str query before it is replaced.
+  maxqueries = 1
+  def StringSort(self):
+    return z3str.StringSort()
+
+  def StringVal(self, v, printable):
+    ## z3str has a weird way of encoding string constants.
+    ## for printing, we make strings look like nice constants,
+    ## but otherwise we use z3str's encoding plan.
+    if printable:
+      return z3.Const('"%s"' % v, z3str.StringSort())
+
+    enc = "__cOnStStR_" + "".join(["_x%02x" % ord(c) for c in v])
+    return z3.Const(enc, z3str.StringSort())
+
+  def String(self, id):
+    return z3.Const(id, z3str.StringSort())
+
+  def decode(self, k, v):
+    vs = str(v)
+    if not vs.startswith('__cOnStStR_'):
+      if not str(k).startswith('_t_'):
+        print 'Undecodable string constant (%s): %s' % (k, vs)
+      return None
+    hexbytes = vs.split('_x')[1:]
+    bytes = [int(h, 16) for h in hexbytes]
+    return ''.join(chr(x) for x in bytes)
+
+  def Concat(self, a, b):
+    return z3str.Concat(a, b)
 
-  signal.signal(signal.SIGALRM, sighandler)
-  signal.alarm(z3_timeout)
+  def Length(self, a):
+    return z3str.Length(a)
 
+  def SubString(self, a, start, length):
+    return z3str.SubString(a, start, length)
+
+  def Indexof(self, a, b):
+    return z3str.Indexof(a, b)
+
+  def Contains(self, a, b):
+    return z3str.Contains(a, b)
+
+  def StartsWith(self, a, b):
+    return z3str.StartsWith(a, b)
+
+  def EndsWith(self, a, b):
+    return z3str.EndsWith(a, b)
+
+  def Replace(self, a, b, c):
+    return z3str.Replace(a, b, c)
+
+  def solver(self, params = ()):
+    ## z3str takes no solver parameters.
+    return OneShotSolver()
+
+  def reset(self):
+    pass
+
+class Z3SeqBackend(object):
+  ## The string theory built into Z3 (4.5 and later).  It needs no
+  ## constant encoding or resets, and its solvers are incremental.
+  maxqueries = None
+  def StringSort(self):
+    return z3.StringSort()
+
+  def StringVal(self, v, printable):
+    return z3.StringVal(v)
+
+  def String(self, id):
+    return z3.String(id)
+
+  def decode(self, k, v):
+    ## Z3 escapes non-printable characters as \u{..}, or as \x.. in
+    ## older releases.
+    return re.sub(r'\\u\{([0-9a-fA-F]+)\}|\\x([0-9a-fA-F]{2})',
+                  lambda m: chr(int(m.group(1) or m.group(2), 16)),
+                  str(v.as_string()))
+
+  def Concat(self, a, b):
+    return z3.Concat(a, b)
+
+  def Length(self, a):
+    return z3.Length(a)
+
+  def SubString(self, a, start, length):
+    return z3.SubString(a, start, length)
+
+  def Indexof(self, a, b):
+    return z3.IndexOf(a, b, 0)
+
+  def Contains(self, a, b):
+    return z3.Contains(a, b)
+
+  def StartsWith(self, a, b):
+    return z3.PrefixOf(b, a)
+
+  def EndsWith(self, a, b):
+    return z3.SuffixOf(b, a)
+
+  def Replace(self, a, b, c):
+    return z3.Replace(a, b, c)
+
+  def solver(self, params = ()):
+    return Z3Solver(params)
+
+  def reset(self):
+    pass
+
+solver_backends = {
+  'z3str': Z3strBackend(),
+  'z3': Z3SeqBackend(),
+}
+
+def get_backend():
+  return solver_backends[solver_backend]
+
+class PathSession(object):
+  ## Incremental solver state for the path most recently explored.
+  ## The negated branches of one path share a growing prefix; it is
+  ## asserted once, one scope per conjunct, and each flipped branch is
+  ## checked in a scope of its own.  A query that shares only part of
+  ## the prefix pops back to the common part first.
+  def __init__(self, solver):
+    self.solver = solver
+    self.asserted = []
+
+  def check(self, prefix, branch):
+    n = 0
+    while n < len(self.asserted) and n < len(prefix) and \
+          self.asserted[n] == prefix[n]:
+      n += 1
+    while len(self.asserted) > n:
+      self.solver.pop()
+      self.asserted.pop()
+    for c in prefix[n:]:
+      self.solver.push()
+      self.solver.add(z3expr(c), track_prefix + str(len(self.asserted)))
+      self.asserted.append(c)
+
+    self.solver.push()
+    self.solver.add(z3expr(branch), track_prefix + str(len(prefix)))
+    try:
+      return z3result(self.solver, *self.solver.check_and_model())
+    finally:
+      self.solver.pop()
+
+## The sessions of this solver process, if it is one, by configuration.
+path_sessions = {}
+
+def solver_request(req):
+  ## Runs in a solver process.  A request is either
+  ## ('check', config, constr) or ('path', config, prefix, branch),
+  ## the latter meaning the conjunction of the prefix list and the
+  ## branch.  "config" is a (backend, params) pair, params being a
+  ## tuple of solver parameters.  The reply is the (ok, model) pair
+  ## from z3result() along with the z3expr() cache counters of this
+  ## process and the time the query took.
+  global solver_backend
+  start = time.time()
+  config = req[1]
+  (solver_backend, params) = config
+  if req[0] == 'check':
+    res = z3check(req[2], params)
+  elif req[0] == 'path':
+    session = path_sessions.get(config)
+    if session is None:
+      session = PathSession(get_backend().solver(params))
+      path_sessions[config] = session
+    res = session.check(req[2], req[3])
+  else:
+    raise Exception("Unknown solver request %s" % (req,))
+  return (res, collect_z3expr_stats(), time.time() - start)
+
+def solver_reset():
+  ## Called in a solver process after every query.
+  get_backend().reset()
+
+def backend_maxqueries():
+  ## How many queries a solver process may answer before it is replaced:
+  ## solver_maxqueries, unless a backend it may run queries for asks for
+  ## fewer.
+  backends = set([solver_backend])
+  if solver_portfolio is not None:
+    backends.update(backend for (backend, _) in solver_portfolio.configs)
+  maxqueries = solver_maxqueries
+  for backend in backends:
+    if solver_backends[backend].maxqueries is not None:
+      maxqueries = min(maxqueries, solver_backends[backend].maxqueries)
+  return maxqueries
+
+solver_pool = None
+def get_solver_pool():
+  ## A portfolio needs a process for each of its configurations.
+  global solver_pool
+  nworkers = solver_nworkers
+  if solver_portfolio is not None:
+    nworkers = max(nworkers, len(solver_portfolio.configs))
+  maxqueries = backend_maxqueries()
+  if solver_pool is not None and \
+     (len(solver_pool.workers) != nworkers or
+      solver_pool.maxqueries != maxqueries):
+    solver_pool.shutdown()
+    solver_pool = None
+  if solver_pool is None:
+    solver_pool = solverpool.SolverPool(solver_request, nworkers,
+                                        reset = solver_reset,
+                                        maxqueries = maxqueries)
+    atexit.register(solver_pool.shutdown)
+  return solver_pool
+
+## Per-query timeouts
+
+class SolverTimeouts(object):
+  ## Picks a timeout for each query from the solve times seen so far:
+  ## "slack" times the 95th percentile of the solve time per AST node,
+  ## times the size of the query, kept between mintimeout and z3_timeout.
+  ## Until enough solves have been seen, queries get z3_timeout.  Solver
+  ## time is charged against an optional per-run budget, in seconds, and
+  ## queries that timed out are remembered with the timeout they had, so
+  ## that they can be retried with "backoff" times as much, up to
+  ## maxretry seconds.
+  def __init__(self, budget = None, mintimeout = 0.25, slack = 4,
+               minsamples = 20, nsamples = 1000,
+               backoff = 4, maxretry = 60):
+    self.budget = budget
+    self.backoff = backoff
+    self.maxretry = maxretry
+    self.mintimeout = mintimeout
+    self.slack = slack
+    self.minsamples = minsamples
+    self.samples = collections.deque(maxlen = nsamples)
+    self.spent = 0.0
+    self.timedout = {}
+
+  def timeout(self, query):
+    t = z3_timeout
+    if len(self.samples) >= self.minsamples:
+      rates = sorted(self.samples)
+      rate = rates[int(len(rates) * 0.95)]
+      t = min(max(self.slack * rate * nodecount(query), self.mintimeout), t)
+    return t
+
+  def retry_timeout(self, query):
+    ## The timeout for another try at a query that timed out, or None
+    ## if it has already had the longest one.
+    t = self.timedout[query] * self.backoff
+    if t > self.maxretry:
+      if self.timedout[query] >= self.maxretry:
+        return None
+      t = self.maxretry
+    return t
+
+  def clamp(self, t):
+    ## Keep a timeout within what is left of the budget.
+    if self.budget is not None:
+      t = min(t, self.budget - self.spent)
+    return t
+
+  def solved(self, query, seconds):
+    self.spent += seconds
+    self.samples.append(seconds / nodecount(query))
+
+  def expired(self, query, timeout):
+    self.spent += timeout
+    self.timedout[query] = timeout
+
+  def exhausted(self):
+    return self.budget is not None and self.spent >= self.budget
+
+solver_timeouts = SolverTimeouts()
+
+## z3expr() cache counters of all solver processes.
+solver_z3expr_stats = {'hits': 0, 'misses': 0}
+
+def solver_result(query, timeout, reply):
+  if isinstance(reply, solverpool.SolverTimeout):
+    print "Timed out.."
+    # print z3expr(query, True).sexpr()
+    solver_timeouts.expired(query, timeout)
+    return (z3.unknown, None)
+  if isinstance(reply, solverpool.SolverCrash):
+    return (z3.unknown, None)
+  ((ok, model), stats, seconds) = reply
+  solver_timeouts.solved(query, seconds)
+  for k in stats:
+    solver_z3expr_stats[k] += stats[k]
+  if ok == z3.unsat and model is not None:
+    ## Turn the indices of the unsat core into conjuncts of the query.
+    conjuncts = conjuncts_of(query)
+    model = [conjuncts[i] for i in model]
+  return (ok, model)
+
+def path_request(conjuncts):
+  conjuncts = [simplify(c) for c in conjuncts]
+  return ('path', (solver_backend, ()), conjuncts[:-1], conjuncts[-1])
+
+def check_request(constr):
+  ## Conjuncts are simplified one by one, so that they keep their
+  ## positions for the unsat core.
+  if isinstance(constr, sym_and):
+    constr = sym_and(*[simplify(c) for c in constr.args])
+  else:
+    constr = simplify(constr)
+  return ('check', (solver_backend, ()), constr)
+
+def fork_and_check_request(query, req, timeout):
+  if timeout is None:
+    timeout = solver_timeouts.timeout(query)
+  timeout = solver_timeouts.clamp(timeout)
+  if timeout <= 0:
+    return (z3.unknown, None)
+  if solver_portfolio is not None:
+    return portfolio_check(query, req, timeout)
+  try:
+    reply = get_solver_pool().check(req, timeout)
+  except (solverpool.SolverTimeout, solverpool.SolverCrash) as e:
+    reply = e
+  return solver_result(query, timeout, reply)
+
+def fork_and_check(constr, timeout = None):
+  ## Without a "timeout", solver_timeouts picks one.  If constr is
+  ## unsat, the model is a list of its conjuncts that are unsat by
+  ## themselves, or None.
+  return fork_and_check_request(constr, check_request(constr), timeout)
+
+def fork_and_check_path(conjuncts, timeout = None):
+  ## Like fork_and_check(sym_and(*conjuncts)), but the solver process
+  ## keeps all but the last conjunct around for the next query.
+  return fork_and_check_request(sym_and(*conjuncts),
+                                path_request(conjuncts), timeout)
+
+def fork_and_check_many(paths, incremental = True):
+  ## Solve several lists of conjuncts at once, spread over the solver
+  ## pool.  Yields (index, (ok, model)) pairs as the answers arrive.
+  ## A portfolio already keeps the pool busy, so with one the paths are
+  ## solved one after another.
+  if solver_portfolio is not None:
+    for (i, conjuncts) in enumerate(paths):
+      if incremental:
+        yield (i, fork_and_check_path(conjuncts))
+      else:
+        yield (i, fork_and_check(sym_and(*conjuncts)))
+    return
+
+  queries = [sym_and(*conjuncts) for conjuncts in paths]
+  timeouts = [solver_timeouts.clamp(solver_timeouts.timeout(query))
+              for query in queries]
+  if incremental:
+    reqs = [path_request(conjuncts) for conjuncts in paths]
+  else:
+    reqs = [check_request(query) for query in queries]
+  for (i, reply) in get_solver_pool().check_many(reqs, timeouts):
+    yield (i, solver_result(queries[i], timeouts[i], reply))
+
+## Solver portfolios
+
+optypes_cache = weakref.WeakKeyDictionary()
+
+def optypes(e):
+  ## The names of the node types that e is built from.
+  ts = optypes_cache.get(e)
+  if ts is None:
+    ts = frozenset([type(e).__name__])
+    if isinstance(e, sym_func_apply):
+      ts = ts.union(*[optypes(a) for a in e.args])
+    optypes_cache[e] = ts
+  return ts
+
+class SolverPortfolio(object):
+  ## Races several solver configurations on each query and takes the
+  ## first sat or unsat answer.  A configuration is a (backend, params)
+  ## pair, params being a dict of solver parameters (see Z3Solver).
+  ## Wins are counted per query shape, the set of node types in the
+  ## query; once a shape has been raced "minraces" times and one
+  ## configuration won at least "dominance" of those, only that
+  ## configuration is run for queries of that shape.
+  def __init__(self, configs, minraces = 10, dominance = 0.9):
+    self.configs = [(backend, tuple(sorted(params.items())))
+                    for (backend, params) in configs]
+    self.minraces = minraces
+    self.dominance = dominance
+    self.wins = collections.defaultdict(collections.Counter)
+
+  def configs_for(self, query):
+    wins = self.wins.get(optypes(query))
+    if wins:
+      ((config, n),) = wins.most_common(1)
+      races = sum(wins.values())
+      if races >= self.minraces and n >= races * self.dominance:
+        return [config]
+    return self.configs
+
+  def won(self, query, config):
+    self.wins[optypes(query)][config] += 1
+
+## The portfolio that fork_and_check() races queries on, if any.
+solver_portfolio = None
+
+def portfolio_check(query, req, timeout):
+  ## Send "req" to every configuration of the portfolio at once.  The
+  ## first definitive answer wins, and the processes still working on
+  ## the query are replaced, which cancels them.
+  configs = solver_portfolio.configs_for(query)
+  reqs = [(req[0], config) + req[2:] for config in configs]
+  reply = solverpool.SolverTimeout()
+  replies = get_solver_pool().check_many(reqs, timeout)
   try:
-    res = parent_conn.recv()
-  except EOFError:
-    res = (z3.unknown, None)
+    for (i, r) in replies:
+      if isinstance(r, Exception):
+        continue
+      reply = r
+      ((ok, model), stats, seconds) = r
+      if ok == z3.sat or ok == z3.unsat:
+        solver_portfolio.won(query, configs[i])
+        break
   finally:
-    signal.alarm(0)
-
-  p.join()
-  return res
+    replies.close()
+  return solver_result(query, timeout, reply)
 
 ## Symbolic type replacements
 
@@ -493,28 +1356,41 @@ def concolic_bool(sym, v):
   ## Python claims that 'bool' is not an acceptable base type,
   ## so it seems difficult to subclass bool.  Luckily, bool has
   ## only two possible values, so whenever we get a concolic
-  ## bool, add its value to the constraint.
-  add_constr(sym_eq(sym, ast(v)))
+  ## bool, add its value to the constraint.  A condition that no
+  ## input affects can never go the other way, so it is left out.
+  if isrelevant(sym):
+    add_constr(sym_eq(sym, ast(v)))
   return v
 
 class concolic_int(int):
+  ## Concolic values are copied and passed around a lot, so they keep
+  ## their concrete and symbolic values in slots, not in a __dict__.
+  __slots__ = ('_v', '_sym')
+
   def __new__(cls, sym, v):
+    ## Results that no input affects are plain values, so that
+    ## operations on them cost nothing extra.
+    if not isrelevant(sym):
+      return v
     self = super(concolic_int, cls).__new__(cls, v)
-    self.__v = v
-    self.__sym = sym
+    self._v = v
+    self._sym = sym
     return self
 
+  def __reduce__(self):
+    return (concolic_int, (self._sym, self._v))
+
   def concrete_value(self):
-    return self.__v
+    return self._v
 
   def __eq__(self, o):
     if not isinstance(o, int):
       return False
 
     if isinstance(o, concolic_int):
-      res = (self.__v == o.__v)
+      res = (self._v == o._v)
     else:
-      res = (self.__v == o)
+      res = (self._v == o)
 
     return concolic_bool(sym_eq(ast(self), ast(o)), res)
 
@@ -522,7 +1398,7 @@ class concolic_int(int):
     return not self.__eq__(o)
 
   def __cmp__(self, o):
-    res = long(self.__v).__cmp__(long(o))
+    res = long(self._v).__cmp__(long(o))
     if concolic_bool(sym_lt(ast(self), ast(o)), res < 0):
       return -1
     if concolic_bool(sym_gt(ast(self), ast(o)), res > 0):
@@ -531,49 +1407,72 @@ class concolic_int(int):
 
   def __add__(self, o):
     if isinstance(o, concolic_int):
-      res = self.__v + o.__v
+      res = self._v + o._v
     else:
-      res = self.__v + o
+      res = self._v + o
     return concolic_int(sym_plus(ast(self), ast(o)), res)
 
   def __radd__(self, o):
-    res = o + self.__v
+    res = o + self._v
     return concolic_int(sym_plus(ast(o), ast(self)), res)
 
   def __sub__(self, o):
-    res = self.__v - o
+    res = self._v - o
     return concolic_int(sym_minus(ast(self), ast(o)), res)
 
   def __mul__(self, o):
-    res = self.__v * o
+    res = self._v * o
     return concolic_int(sym_mul(ast(self), ast(o)), res)
 
   def __div__(self, o):
-    res = self.__v / o
+    res = self._v / o
     return concolic_int(sym_div(ast(self), ast(o)), res)
 
   def _sym_ast(self):
-    return self.__sym
+    return self._sym
+
+## str subclasses cannot have slots of their own, so the concrete and
+## symbolic values of each concolic_str live here, by id().
+concolic_str_values = {}
 
 class concolic_str(str):
+  __slots__ = ()
+
   def __new__(cls, sym, v):
     assert type(v) == str or type(v) == unicode
+    if not isrelevant(sym):
+      return v
     self = super(concolic_str, cls).__new__(cls, v)
-    self.__v = v
-    self.__sym = sym
+    concolic_str_values[id(self)] = (v, sym)
     return self
 
+  def __del__(self, values = concolic_str_values):
+    ## "values" is bound here, as module globals may already be gone
+    ## when the last concolic strings are freed at exit.
+    values.pop(id(self), None)
+
+  @property
+  def _v(self):
+    return concolic_str_values[id(self)][0]
+
+  @property
+  def _sym(self):
+    return concolic_str_values[id(self)][1]
+
+  def __reduce__(self):
+    return (concolic_str, (self._sym, self._v))
+
   def concrete_value(self):
-    return self.__v
+    return self._v
 
   def __eq__(self, o):
     if not isinstance(o, str) and not isinstance(o, unicode):
       return False
 
     if isinstance(o, concolic_str):
-      res = (self.__v == o.__v)
+      res = (self._v == o._v)
     else:
-      res = (self.__v == o)
+      res = (self._v == o)
 
     return concolic_bool(sym_eq(ast(self), ast(o)), res)
 
@@ -582,33 +1481,33 @@ class concolic_str(str):
 
   def __add__(self, o):
     if isinstance(o, concolic_str):
-      res = self.__v + o.__v
+      res = self._v + o._v
     else:
-      res = self.__v + o
+      res = self._v + o
     return concolic_str(sym_concat(ast(self), ast(o)), res)
 
   def __radd__(self, o):
-    res = o + self.__v
+    res = o + self._v
     return concolic_str(sym_concat(ast(o), ast(self)), res)
 
   def __len__(self):
-    res = len(self.__v)
+    res = len(self._v)
     return concolic_int(sym_length(ast(self)), res)
 
   def __contains__(self, o):
-    res = o in self.__v
+    res = o in self._v
     return concolic_bool(sym_contains(ast(self), ast(o)), res)
 
   def startswith(self, o):
-    res = self.__v.startswith(o)
+    res = self._v.startswith(o)
     return concolic_bool(sym_startswith(ast(self), ast(o)), res)
 
   def endswith(self, o):
-    res = self.__v.endswith(o)
+    res = self._v.endswith(o)
     return concolic_bool(sym_endswith(ast(self), ast(o)), res)
 
   def __getitem__(self, i):
-    res = self.__v[i]
+    res = self._v[i]
     return concolic_str(sym_substring(ast(self), ast(i), ast(1)), res)
 
   def __getslice__(self, i, j):
@@ -617,11 +1516,11 @@ class concolic_str(str):
       ## Unfortunately, this differs depending on whether you're
       ## running in a 32-bit or a 64-bit system.
       j = self.__len__()
-    res = self.__v[i:j]
+    res = self._v[i:j]
     return concolic_str(sym_substring(ast(self), ast(i), ast(j-i)), res)
 
   def find(self, ch):
-    res = self.__v.find(ch)
+    res = self._v.find(ch)
     return concolic_int(sym_indexof(ast(self), ast(ch)), res)
 
   def decode(self, encoding = sys.getdefaultencoding(), errors = 'strict'):
@@ -646,9 +1545,9 @@ class concolic_str(str):
 
   def rsplit(self, sep = None, maxsplit = -1):
     if maxsplit != 1 or type(sep) != str:
-      return self.__v.rsplit(sep, maxsplit)
+      return self._v.rsplit(sep, maxsplit)
 
-    name = 'rsplit_%s_%s' % (self.__sym, sep)
+    name = 'rsplit_%s_%s' % (self._sym, sep)
     l = mk_str(name + '_l')
     r = mk_str(name + '_r')
     if l + sep + r != self:
@@ -665,7 +1564,7 @@ class concolic_str(str):
     return self
 
   def _sym_ast(self):
-    return self.__sym
+    return self._sym
 
 ## Override some builtins..
 
@@ -676,6 +1575,82 @@ def xlen(o):
   return old_len(o)
 __builtin__.len = xlen
 
+## Tree of explored paths
+
+class PathTrie(object):
+  ## A node in the prefix tree of the path conditions seen so far.
+  ## The path from the root to a node spells out a list of conjuncts;
+  ## paths that share a prefix share the nodes for it, so a run keeps
+  ## one node per distinct prefix instead of every path condition in
+  ## full.  "explored" marks the path conditions already sent off to be
+  ## solved.
+  __slots__ = ('parent', 'conjunct', 'children', 'explored')
+
+  def __init__(self, parent = None, conjunct = None):
+    self.parent = parent
+    self.conjunct = conjunct
+    self.children = None
+    self.explored = False
+
+  def walk(self, conjuncts):
+    ## The node for this node's path extended with "conjuncts",
+    ## creating nodes as needed.
+    node = self
+    for c in conjuncts:
+      if node.children is None:
+        node.children = {}
+      child = node.children.get(c)
+      if child is None:
+        child = PathTrie(node, c)
+        node.children[c] = child
+      node = child
+    return node
+
+  def conjuncts(self):
+    l = []
+    node = self
+    while node.parent is not None:
+      l.append(node.conjunct)
+      node = node.parent
+    l.reverse()
+    return l
+
+  def path_condition(self):
+    return sym_and(*self.conjuncts())
+
+  def flatten(self):
+    ## The tree below this node as a list of (parent, conjunct, explored)
+    ## triples, one for each node, with parents ahead of their children;
+    ## "parent" is the position of the parent in the list, or -1 for
+    ## this node.  Also returns a map from each node to its position.
+    ## The tree is walked with a stack of its own, as it may be too deep
+    ## for recursion, or for pickling as it is.
+    nodes = []
+    index = {self: -1}
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if node.children is None:
+        continue
+      for child in node.children.itervalues():
+        index[child] = len(nodes)
+        nodes.append((index[node], child.conjunct, child.explored))
+        stack.append(child)
+    return (nodes, index)
+
+  def unflatten(self, nodes):
+    ## Add the nodes of a list made by flatten() below this node, and
+    ## return them in the order of the list.
+    l = []
+    for (parent, c, explored) in nodes:
+      if parent < 0:
+        node = self.walk([c])
+      else:
+        node = l[parent].walk([c])
+      node.explored = explored
+      l.append(node)
+    return l
+
 ## Track inputs that should be tried later
 
 class InputQueue(object):
@@ -685,24 +1660,37 @@ class InputQueue(object):
     ## name to the value we should try.  If a value is not present,
     ## mk_int() and mk_str() below will pick a default value.  Each
     ## input also has a priority (lower is "more important"), which
-    ## is useful when there's too many inputs to process.
-    self.inputs = Queue.PriorityQueue()
-    self.inputs.put((0, {'values': {}, 'path_condition': None}))
-    self.input_history = []
+    ## is useful when there's too many inputs to process.  Inputs of
+    ## the same priority are tried in the order they were added.
+    self.inputs = []
+    self.seq = itertools.count()
+    self.put(0, {'values': {}, 'path_node': None})
+
+    ## "input_history" is the set of inputs added so far, each as a
+    ## frozenset of its (name, value) pairs.
+    self.input_history = set()
 
     ## "branchcount" is a map from call site (filename and line number)
     ## to the number of branches we have already explored at that site.
     ## This is used to choose priorities for inputs.
     self.branchcount = collections.defaultdict(int)
 
+  def put(self, prio, values):
+    heapq.heappush(self.inputs, (prio, next(self.seq), values))
+
   def empty(self):
-    return self.inputs.empty()
+    return len(self.inputs) == 0
 
   def get(self):
-    (prio, values) = self.inputs.get()
-    return (values['values'], values['path_condition'])
-
-  def add(self, new_values, caller, path_condition, uniqueinputs = False):
+    ## Inputs refer to the PathTrie node of the path they were solved
+    ## for; the path condition itself is only built here.
+    (prio, _, values) = heapq.heappop(self.inputs)
+    path_node = values['path_node']
+    if path_node is None:
+      return (values['values'], None)
+    return (values['values'], path_node.path_condition())
+
+  def add(self, new_values, caller, path_node, uniqueinputs = False):
     if uniqueinputs:
       if self.check_input_history(new_values):
         if verbose > 1:
@@ -711,29 +1699,126 @@ class InputQueue(object):
 
     prio = self.branchcount[caller[0]]
     self.branchcount[caller[0]] += 1
-    self.inputs.put((prio, {'values': new_values, 'path_condition': path_condition}))
+    self.put(prio, {'values': new_values, 'path_node': path_node})
 
     if uniqueinputs:
-      self.input_history.append((prio, new_values))
+      self.input_history.add(frozenset(new_values.iteritems()))
 
   def check_input_history(self, new_values):
     ## Return True if new_values has been added to the input queue before.
-    for (prio, values) in self.input_history:
-      if self.value_dicts_match(values, new_values):
-        return True
-    return False
+    return frozenset(new_values.iteritems()) in self.input_history
+
+  def save(self, index):
+    ## The state of the queue, with each path node replaced by its
+    ## position in "index", as returned by PathTrie.flatten().
+    inputs = []
+    for (prio, seq, values) in self.inputs:
+      path_node = values['path_node']
+      if path_node is not None:
+        path_node = index[path_node]
+      inputs.append((prio, seq, values['values'], path_node))
+    return (inputs, self.input_history, dict(self.branchcount))
+
+  def restore(self, state, nodes):
+    ## Undo save(), given the path nodes returned by PathTrie.unflatten().
+    (inputs, self.input_history, branchcount) = state
+    self.inputs = []
+    for (prio, seq, values, path_node) in inputs:
+      if path_node is not None:
+        path_node = nodes[path_node]
+      self.inputs.append((prio, seq, {'values': values,
+                                      'path_node': path_node}))
+    heapq.heapify(self.inputs)
+    self.seq = itertools.count(max([-1] + [seq for (_, seq, _)
+                                           in self.inputs]) + 1)
+    self.branchcount = collections.defaultdict(int, branchcount)
+
+## Cache of solutions to previously checked path conditions
+
+class CexCache(object):
+  ## Maps path conditions (sym_and nodes) to the values that satisfy
+  ## them, or to None if they have no solution (a counterexample).
+  ## Entries are indexed by conjunct, so that finding an unsat subset
+  ## or a sat superset of a path condition only visits the entries that
+  ## share a conjunct with it, rather than scanning the whole cache.
+  def __init__(self):
+    self.entries = {}
+    self.unsat_index = {}
+    self.sat_index = {}
 
-  def value_dicts_match(self, old_values, new_values):
-    if len(old_values) != len(new_values):
-      return False
-    if len(old_values) == 0:
-      return True
-    for k in old_values:
-      if k not in new_values:
-        return False
-      if old_values[k] != new_values[k]:
-        return False
-    return True
+    ## number of distinct conjuncts of each unsat entry.
+    self.unsat_size = {}
+
+    self.stats = {'sat': 0, 'unsat': 0, 'misses': 0}
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __iter__(self):
+    return iter(self.entries)
+
+  def __contains__(self, path_condition):
+    return path_condition in self.entries
+
+  def __getitem__(self, path_condition):
+    return self.entries[path_condition]
+
+  def __setitem__(self, path_condition, values):
+    if path_condition in self.entries:
+      del self[path_condition]
+    self.entries[path_condition] = values
+
+    conjuncts = set(path_condition.args)
+    if values is None:
+      index = self.unsat_index
+      self.unsat_size[path_condition] = len(conjuncts)
+    else:
+      index = self.sat_index
+    for c in conjuncts:
+      index.setdefault(c, set()).add(path_condition)
+
+  def __delitem__(self, path_condition):
+    values = self.entries.pop(path_condition)
+    if values is None:
+      index = self.unsat_index
+      del self.unsat_size[path_condition]
+    else:
+      index = self.sat_index
+    for c in set(path_condition.args):
+      index[c].discard(path_condition)
+      if len(index[c]) == 0:
+        del index[c]
+
+  def lookup(self, path_condition):
+    conjuncts = set(path_condition.args)
+
+    ## An unsat entry is a subset of path_condition if every one of its
+    ## conjuncts shows up while walking the conjuncts of path_condition.
+    seen = {}
+    for c in conjuncts:
+      for old_path in self.unsat_index.get(c, ()):
+        n = seen.get(old_path, 0) + 1
+        if n == self.unsat_size[old_path]:
+          self.stats['unsat'] += 1
+          return (z3.unsat, None)
+        seen[old_path] = n
+
+    ## A sat entry is a superset of path_condition if it is indexed
+    ## under every one of its conjuncts.
+    postings = sorted([self.sat_index.get(c, ()) for c in conjuncts], key=len)
+    if len(postings) == 0:
+      candidates = [p for p in self.entries if self.entries[p] is not None]
+    else:
+      candidates = set(postings[0])
+      for p in postings[1:]:
+        if len(candidates) == 0:
+          break
+        candidates &= p
+    for old_path in candidates:
+      self.stats['sat'] += 1
+      return (z3.sat, self.entries[old_path])
+    self.stats['misses'] += 1
+    return (None, None)
 
 ## Actual concolic execution API
 
@@ -751,47 +1836,315 @@ def mk_str(id, value = ''):
     concrete_values[id] = value
   return concolic_str(sym_str(id), concrete_values[id])
 
+## Running the test function once, for the current concrete values.
+## Either way, the branches it took end up in cur_path_constr and
+## cur_path_constr_callers, and the values it used in concrete_values.
+
+def run_testfunc(testfunc):
+  global cur_path_constr, cur_path_constr_callers
+  cur_path_constr = []
+  cur_path_constr_callers = []
+  try:
+    testfunc()
+  except RequireMismatch:
+    pass
+
+def fork_testfunc(testfunc):
+  ## Run the test function in a child process forked from this one, so
+  ## that it starts from the state the setup phase left behind, and
+  ## whatever it changes in memory is gone once it exits.  The child
+  ## sends its branches back over a pipe.  Changes it makes outside its
+  ## own memory, such as to files or databases, are not undone.
+  global cur_path_constr, cur_path_constr_callers, concrete_values
+  sys.stdout.flush()
+  sys.stderr.flush()
+  (r, w) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(r)
+      try:
+        run_testfunc(testfunc)
+        res = ('ok', (cur_path_constr, cur_path_constr_callers,
+                      concrete_values))
+      except BaseException:
+        res = ('error', traceback.format_exc())
+      f = os.fdopen(w, 'wb')
+      cPickle.dump(res, f, 2)
+      f.close()
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      ## Skip atexit handlers, which belong to the parent (such as
+      ## shutting down the solver pool).
+      os._exit(0)
+
+  os.close(w)
+  f = os.fdopen(r, 'rb')
+  data = f.read()
+  f.close()
+  os.waitpid(pid, 0)
+  if len(data) == 0:
+    raise Exception("Test function process %d died" % pid)
+  (status, res) = cPickle.loads(data)
+  if status == 'error':
+    raise Exception("Test function failed in process %d:\n%s" % (pid, res))
+  (cur_path_constr, cur_path_constr_callers, concrete_values) = res
+
+class TestWorker(object):
+  ## Runs the test function on the inputs it is sent, in one of the
+  ## processes of a parallel concolic_test(), and returns its branches.
+  ## Each request is the concrete values to run with, along with the
+  ## path condition they were solved for, which mutation querysets
+  ## (see symqueryset.py) read from path_condition.
+  def __init__(self, testfunc, init = None, forkserver = False):
+    self.testfunc = testfunc
+    self.init = init
+    self.forkserver = forkserver
+    self.started = False
+
+  def __call__(self, req):
+    global concrete_values, path_condition
+    if not self.started:
+      self.started = True
+      if self.init is not None:
+        self.init()
+    (concrete_values, path_condition) = req
+    try:
+      if self.forkserver:
+        fork_testfunc(self.testfunc)
+      else:
+        run_testfunc(self.testfunc)
+    except Exception:
+      return ('error', traceback.format_exc())
+    return ('ok', (cur_path_constr, cur_path_constr_callers,
+                   concrete_values))
+
+def concolic_worker(testfunc, address, authkey,
+                    setup = None,
+                    testinit = None,
+                    forkserver = False):
+  ## Run testfunc on the inputs sent by a concolic_test() listening on
+  ## "address", until it stops.  "setup", "testinit" and "forkserver"
+  ## are as for concolic_test().
+  if setup is not None:
+    setup()
+  remotepool.serve(address, TestWorker(testfunc, testinit, forkserver),
+                   authkey)
+
+def save_checkpoint(path, state):
+  ## Write "state" to "path", such that a crash while writing it leaves
+  ## the last checkpoint in place.
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(zlib.compress(cPickle.dumps(state, 2)))
+  os.rename(tmp, path)
+
+def load_checkpoint(path):
+  with open(path, 'rb') as f:
+    return cPickle.loads(zlib.decompress(f.read()))
+
 verbose = 0
 def concolic_test(testfunc, maxiter = 100, v = 0,
                   uniqueinputs = True,
                   removeredundant = True,
-                  usecexcache = True):
+                  usecexcache = True,
+                  solverprocs = 1,
+                  incremental = True,
+                  cachefile = None,
+                  slicing = True,
+                  modelreuse = 16,
+                  solverbudget = None,
+                  backend = 'z3str',
+                  portfolio = None,
+                  setup = None,
+                  forkserver = False,
+                  testprocs = 1,
+                  testinit = None,
+                  listen = None,
+                  authkey = None,
+                  checkpoint = None,
+                  checkpointevery = 100,
+                  resume = False):
   # globally available 'verbose' flag
   verbose = v
 
-  ## "checked" is the set of constraints we already sent to Z3 for
-  ## checking.  use this to eliminate duplicate paths.
-  checked_paths = set()
+  ## whole call stacks of branches are only printed at verbose > 2.
+  global caller_stacks
+  caller_stacks = verbose > 2
+
+  ## with more than one solver process, the branches of each iteration
+  ## are solved concurrently instead of one after another.
+  global solver_nworkers
+  solver_nworkers = solverprocs
+
+  ## which of solver_backends to solve queries with.
+  global solver_backend
+  solver_backend = backend
+
+  ## solver configurations to race on every query, if any, as a list
+  ## of (backend, params) pairs.
+  global solver_portfolio
+  solver_portfolio = None
+  if portfolio is not None:
+    solver_portfolio = SolverPortfolio(portfolio)
+  for k in solver_z3expr_stats:
+    solver_z3expr_stats[k] = 0
+
+  ## per-query solver timeouts, and the total solver time for this run,
+  ## in seconds, if it is limited.
+  global solver_timeouts
+  solver_timeouts = SolverTimeouts(budget = solverbudget)
+
+  ## "explored" is the tree of path conditions; the nodes of those we
+  ## already sent to Z3 for checking are marked, to eliminate duplicate
+  ## paths.
+  explored = PathTrie()
 
   ## list of inputs we should try to explore.
   inputs = InputQueue()
 
   ## cache of solutions to previously checked path conditions,
   ## or lack thereof, being a counterexample.
-  ## a dictionary that maps path conditions to value assignments.
-  cexcache = {}
-
-  iter = 0
-  while iter < maxiter and not inputs.empty():
-    iter += 1
-
-    global concrete_values
-    global path_condition
-    (concrete_values, path_condition) = inputs.get()
-
-    global cur_path_constr, cur_path_constr_callers
-    cur_path_constr = []
-    cur_path_constr_callers = []
-
+  ## maps path conditions to value assignments.
+  cexcache = CexCache()
+
+  ## persistent cache of solver results shared across runs, if any.
+  diskcache = None
+  if cachefile is not None:
+    diskcache = solvercache.SolverCache(cachefile)
+
+  ## the last "modelreuse" satisfying models; a new query that one of
+  ## them satisfies needs no solver call.
+  recent_models = collections.deque(maxlen = modelreuse)
+  reuse_stats = {'hits': 0, 'misses': 0}
+
+  def reuse_model(query):
+    ## Only the variables of the query are taken from a recent model;
+    ## its other values may break conjuncts that slicing dropped.
+    names = symvars(query)
+    for model in reversed(recent_models):
+      solution = dict((k, model[k]) for k in names if k in model)
+      values = dict(concrete_values)
+      values.update(solution)
+      if satisfies(query, values):
+        reuse_stats['hits'] += 1
+        return solution
+    reuse_stats['misses'] += 1
+    return None
+
+  def remember(query, ok, model):
+    if ok == z3.sat and modelreuse > 0:
+      recent_models.append(model)
+    if diskcache is not None and (ok == z3.sat or ok == z3.unsat):
+      diskcache.put(cache_key(query), str(ok), model, query)
+
+  ## queries that timed out, to be retried with a larger timeout once
+  ## the input queue runs dry.  maps each query to the path node, call
+  ## site and concrete values it came from.
+  deferred = collections.OrderedDict()
+
+  def solved(query, path_node, caller, ok, model, base):
+    ## If a solution was found, put it on the input queue,
+    ## (if it hasn't been inserted before).  "base" holds the concrete
+    ## values of the run the branch was taken in.  With "slicing", the
+    ## solution only covers the variables of the sliced query; the
+    ## others keep their values from "base".
+    if ok == z3.sat:
+      ## A model may also set variables the sliced query does not refer
+      ## to, such as one taken from a cached solution to another path.
+      ## Their values could break the conjuncts that slicing dropped, so
+      ## only the variables of the query are taken from it.
+      names = symvars(query)
+      new_values = {}
+      for k in model:
+        if k in base and (not slicing or k in names):
+          new_values[k] = model[k]
+      if usecexcache:
+        cexcache[query] = new_values
+      if slicing:
+        solution = new_values
+        new_values = dict(base)
+        new_values.update(solution)
+
+      if verbose > 0:
+        check_values = dict(base)
+        check_values.update(new_values)
+        pc = path_node.path_condition()
+        if not satisfies(pc, check_values):
+          print 'Input does not satisfy', \
+                indent(z3expr(pc, True))
+
+      inputs.add(new_values, caller, path_node, uniqueinputs)
+    elif ok == z3.unsat:
+      ## "model" may be an unsat core of the query; any path condition
+      ## that contains the core is unsat as well.
+      if usecexcache:
+        if model:
+          cexcache[sym_and(*model)] = None
+        else:
+          cexcache[query] = None
+    elif query in solver_timeouts.timedout:
+      deferred[query] = (path_node, caller, base)
+
+  def retry_timeouts():
+    ## Give each deferred query one more try with a larger timeout.
+    ## Returns whether any query was retried.
+    retried = False
+    for query in deferred.keys():
+      if solver_timeouts.exhausted():
+        break
+      (path_node, caller, base) = deferred.pop(query)
+      timeout = solver_timeouts.retry_timeout(query)
+      if timeout is None:
+        continue
+      if verbose > 1:
+        print "RETRYING WITH TIMEOUT", timeout
+      expired = solver_timeouts.timedout[query]
+      (ok, model) = fork_and_check(query, timeout)
+      retried = True
+      remember(query, ok, model)
+      ## A query that fails on its retry for any reason but another
+      ## timeout, such as an unknown answer or a crash, is given up on.
+      if ok != z3.sat and ok != z3.unsat and \
+         solver_timeouts.timedout[query] == expired:
+        continue
+      solved(query, path_node, caller, ok, model, base)
+    return retried
+
+  ## "setup" does the work that is the same for every input, once.  With
+  ## "forkserver", every run of testfunc starts from the state it left
+  ## behind, in a process of its own.  With "listen", testfunc only runs
+  ## in remote workers, which do their own setup.
+  if setup is not None and listen is None:
+    setup()
+
+  ## With more than one test process, that many inputs are run at once,
+  ## each by one of a pool of processes forked after setup.  "testinit"
+  ## is called in each of them before its first run, to give it a
+  ## database of its own, for example.  The branches of all runs are
+  ## explored, and their queries solved, in this process.
+  testpool = None
+  if testprocs > 1:
+    testpool = solverpool.SolverPool(TestWorker(testfunc, testinit,
+                                                forkserver),
+                                     nworkers = testprocs)
+
+  ## With "listen", inputs are run instead by workers that connect to
+  ## that address (see concolic_worker), each of which is handed the
+  ## next input as soon as it is free.
+  if listen is not None:
+    testpool = remotepool.RemotePool(listen, authkey)
     if verbose > 0:
-      # print 'Trying concrete values:', ["%s = %s" % (k, concrete_values[k]) for k in concrete_values if not k.startswith('_t_')]
-      print 'Trying concrete values:', ["%s = %s" % (k, concrete_values[k]) for k in concrete_values]
+      print 'Waiting for workers on', testpool.address
 
-    try:
-      testfunc()
-    except RequireMismatch:
-      pass
+  global concrete_values
+  global cur_path_constr, cur_path_constr_callers
+  global path_condition
 
+  def explore_branches():
+    ## Look for new paths next to the one the last run of testfunc took,
+    ## on the inputs in concrete_values.
     if verbose > 1:
       print 'Test generated', len(cur_path_constr), 'branches:'
       for (c, caller) in zip(cur_path_constr, cur_path_constr_callers):
@@ -806,6 +2159,7 @@ def concolic_test(testfunc, maxiter = 100, v = 0,
     ## the other way, and add it to the list of inputs to explore.
 
     partial_path = []
+    tosolve = []
     for (branch_condition, caller) in \
         zip(cur_path_constr, cur_path_constr_callers):
 
@@ -818,40 +2172,220 @@ def concolic_test(testfunc, maxiter = 100, v = 0,
       else:
         new_branch = partial_path + [sym_not(branch_condition)]
         partial_path = partial_path + [branch_condition]
-      new_path_condition = sym_and(*new_branch)
-      if new_path_condition in checked_paths:
+      path_node = explored.walk(new_branch)
+      if path_node.explored:
         continue
 
       ## Solve for a set of inputs that goes down the new branch.
       ## Avoid solving the branch again in the future.
-      (ok, model) = (None, None)
+      path_node.explored = True
+
+      ## With "slicing", only the conjuncts that share symbolic variables
+      ## with the flipped branch, directly or through other conjuncts, are
+      ## solved for; the current concrete values satisfy the rest.
+      if slicing:
+        new_branch = independent_slice(new_branch)
+      query = sym_and(*new_branch)
+
       if usecexcache:
-        (ok, model) = check_cache(new_path_condition, cexcache)
-        if ok != None:
+        (ok, model) = check_cache(query, cexcache)
+        if ok != None:
           if verbose > 1:
             print "USED CEXCACHE"
-        else:
-          (ok, model) = fork_and_check(new_path_condition)
-      else:
-        (ok, model) = fork_and_check(new_path_condition)
-      checked_paths.add(new_path_condition)
-
-      ## If a solution was found, put it on the input queue,
-      ## (if it hasn't been inserted before).
-      if ok == z3.sat:
-        new_values = {}
-        for k in model:
-          if k in concrete_values:
-            new_values[k] = model[k]
-        inputs.add(new_values, caller, new_path_condition, uniqueinputs)
-        if usecexcache:
-          cexcache[new_path_condition] = new_values
+          solved(query, path_node, caller, ok, model,
+                 concrete_values)
+          continue
+
+      ## Maybe an earlier run has solved this branch already.
+      if diskcache is not None:
+        cached = diskcache.get(cache_key(query))
+        if cached is not None:
+          (ok, model) = cached
+          ok = {'sat': z3.sat, 'unsat': z3.unsat}[ok]
+          solved(query, path_node, caller, ok, model,
+                 concrete_values)
+          continue
+
+      ## Maybe a recent solution for another branch fits this one too.
+      if modelreuse > 0:
+        model = reuse_model(query)
+        if model is not None:
+          if verbose > 1:
+            print "REUSED MODEL"
+          solved(query, path_node, caller, z3.sat, model,
+                 concrete_values)
+          continue
+
+      ## Don't ask the solver again about a query that timed out; it gets
+      ## another try once the input queue runs dry.
+      if query in solver_timeouts.timedout:
+        deferred.setdefault(query, (path_node, caller,
+                                    concrete_values))
+        continue
+      if solver_timeouts.exhausted():
+        continue
+
+      ## With several solver processes, collect the branches and
+      ## solve them all at once below.
+      if solverprocs > 1:
+        tosolve.append((query, path_node, list(new_branch), caller))
+        continue
+
+      ## With "incremental", the solver process keeps the prefix shared
+      ## by the branches of this path asserted, instead of solving each
+      ## branch from scratch.
+      if incremental:
+        (ok, model) = fork_and_check_path(new_branch)
       else:
-        if usecexcache:
-          cexcache[new_path_condition] = None
+        (ok, model) = fork_and_check(query)
+      remember(query, ok, model)
+      solved(query, path_node, caller, ok, model,
+                 concrete_values)
+
+    if len(tosolve) > 0:
+      paths = [b for (_, _, b, _) in tosolve]
+      for (i, (ok, model)) in fork_and_check_many(paths, incremental):
+        (query, path_node, _, caller) = tosolve[i]
+        remember(query, ok, model)
+        solved(query, path_node, caller, ok, model,
+                 concrete_values)
+
+  ## With "checkpoint", the state of the run is saved to that file every
+  ## "checkpointevery" iterations, and once it ends.  With "resume", the
+  ## run carries on from the state saved there, if any: the iterations
+  ## it already did count towards maxiter, and the paths it explored
+  ## are not solved again.
+  def save_state():
+    (nodes, index) = explored.flatten()
+    save_checkpoint(checkpoint, {
+      'iter': iter,
+      'paths': nodes,
+      'inputs': inputs.save(index),
+      'cexcache': (cexcache.entries.items(), cexcache.stats),
+      'deferred': [(query, index[path_node], caller, base)
+                   for (query, (path_node, caller, base))
+                   in deferred.iteritems()],
+      'timeouts': (solver_timeouts.samples, solver_timeouts.spent,
+                   solver_timeouts.timedout),
+      'models': (list(recent_models), reuse_stats),
+    })
+
+  iter = 0
+  if checkpoint is not None and resume and os.path.exists(checkpoint):
+    state = load_checkpoint(checkpoint)
+    iter = state['iter']
+    nodes = explored.unflatten(state['paths'])
+    inputs.restore(state['inputs'], nodes)
+    (entries, stats) = state['cexcache']
+    for (query, values) in entries:
+      cexcache[query] = values
+    cexcache.stats.update(stats)
+    for (query, path_node, caller, base) in state['deferred']:
+      deferred[query] = (nodes[path_node], caller, base)
+    (samples, spent, timedout) = state['timeouts']
+    solver_timeouts.samples.extend(samples)
+    solver_timeouts.spent = spent
+    solver_timeouts.timedout = timedout
+    (models, stats) = state['models']
+    recent_models.extend(models)
+    reuse_stats.update(stats)
+    if verbose > 0:
+      print 'Resuming after', iter, 'iterations, with', \
+            len(nodes), 'path nodes and', len(cexcache), 'cached solutions'
+    del state, nodes
+
+  def trying(values):
+    if verbose > 0:
+      # print 'Trying concrete values:', ["%s = %s" % (k, values[k]) for k in values if not k.startswith('_t_')]
+      print 'Trying concrete values:', ["%s = %s" % (k, values[k]) for k in values]
+
+  def done(res):
+    ## Explore the branches of a run in the test pool.
+    global cur_path_constr, cur_path_constr_callers, concrete_values
+    if isinstance(res, solverpool.SolverCrash):
+      raise Exception("Test process died")
+    (status, res) = res
+    if status == 'error':
+      raise Exception("Test function failed:\n%s" % res)
+    (cur_path_constr, cur_path_constr_callers, concrete_values) = res
+    explore_branches()
+
+  saved = iter
+  while True:
+    if checkpoint is not None and iter - saved >= checkpointevery and \
+       (testpool is None or testpool.pending() == 0):
+      save_state()
+      saved = iter
+
+    ## With a pool of test processes, each one is handed the next input
+    ## as soon as it is free, and the branches of each run are explored
+    ## as soon as it finishes.  A checkpoint that is due waits for the
+    ## runs in progress.  If a run fails, stop the workers, which would
+    ## otherwise wait for more inputs; remote ones do not go away with
+    ## this process.
+    if testpool is not None:
+      try:
+        while iter < maxiter and not inputs.empty() and \
+              (checkpoint is None or iter - saved < checkpointevery) and \
+              testpool.ready():
+          iter += 1
+          (values, path_condition) = inputs.get()
+          trying(values)
+          testpool.submit((values, path_condition))
+        if testpool.pending() > 0:
+          for res in testpool.results():
+            done(res)
+          continue
+      except:
+        testpool.shutdown()
+        raise
+
+    if iter >= maxiter:
+      break
+    if inputs.empty() and not retry_timeouts():
+      break
+    if inputs.empty() or testpool is not None:
+      continue
+
+    iter += 1
+    (concrete_values, path_condition) = inputs.get()
+    trying(concrete_values)
+    if forkserver:
+      fork_testfunc(testfunc)
+    else:
+      run_testfunc(testfunc)
+    explore_branches()
+
+  if testpool is not None:
+    testpool.shutdown()
+
+  if checkpoint is not None:
+    save_state()
 
   if verbose > 0:
     print 'Stopping after', iter, 'iterations'
+    print 'Z3 translation cache: %d hits, %d misses' % \
+          (solver_z3expr_stats['hits'], solver_z3expr_stats['misses'])
+    if usecexcache:
+      print 'Counterexample cache: %d sat hits, %d unsat hits, %d misses' % \
+            (cexcache.stats['sat'], cexcache.stats['unsat'],
+             cexcache.stats['misses'])
+    if diskcache is not None:
+      print 'Persistent solver cache: %d hits, %d misses' % \
+            (diskcache.hits, diskcache.misses)
+    if modelreuse > 0:
+      print 'Model reuse: %d hits, %d misses' % \
+            (reuse_stats['hits'], reuse_stats['misses'])
+    print 'Solver time: %.1f seconds, %d queries timed out' % \
+          (solver_timeouts.spent, len(solver_timeouts.timedout))
+    if solver_portfolio is not None:
+      for config in solver_portfolio.configs:
+        wins = sum(w[config] for w in solver_portfolio.wins.values())
+        print 'Portfolio: %s %s won %d races' % \
+              (config[0], dict(config[1]), wins)
+
+  if diskcache is not None:
+    diskcache.close()
 
 def check_cache(path_condition, cache):
   ## return (ok, model) where
@@ -859,14 +2393,7 @@ def check_cache(path_condition, cache):
   ## ok = z3.sat if a superset of path_condition has a solution.
   ## ok = None if neither of the above can be ascertained.
 
-  for old_path in cache:
-    if cache[old_path] is None and \
-       issubset(old_path.args, path_condition.args):
-      return (z3.unsat, None)
-    if cache[old_path] is not None and \
-       issubset(path_condition.args, old_path.args):
-      return (z3.sat, cache[old_path])
-  return (None, None)
+  return cache.lookup(path_condition)
 
   # (ok, model) = fork_and_check(path_condition)
   # return (ok, model)
@@ -1004,13 +2531,15 @@ def equalityImplies(a, c):
   return False
 
 def isrelevant(ast):
-  global concrete_values
-  if isinstance(ast, sym_int) or isinstance(ast, sym_str):
-    if ast.id in concrete_values:
-      return True
+  ## Whether ast depends on an input, that is, on a variable that
+  ## mk_int() or mk_str() has given a concrete value.  Most nodes that
+  ## concolic operations build have such a variable as an argument,
+  ## which saves looking up (and caching) all the variables of the node.
   if isinstance(ast, sym_func_apply):
-    # Recurse on the ast's arguments.
-    for arg in ast.args:
-      if isrelevant(arg):
+    for a in ast.args:
+      if isinstance(a, (sym_int, sym_str)) and a.id in concrete_values:
         return True
+  for id in symvars(ast):
+    if id in concrete_values:
+      return True
   return False
@@ -0,0 +1,151 @@
+## A pool of worker processes that connect over the network.
+##
+## For runs spread over several machines, the coordinator listens on a
+## TCP address, or a Unix socket path, and workers started anywhere
+## connect to it and answer the requests it sends, one at a time.
+## Workers may join at any time; when one goes away, its request is
+## handed to another, up to "maxretries" times.  Requests and answers
+## are pickled, so both ends must share an authentication key.
+
+import Queue
+import select
+import socket
+import threading
+import time
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from solverpool import SolverCrash
+
+class RemotePool(object):
+  def __init__(self, address, authkey, maxretries = 2):
+    if authkey is None:
+      raise Exception("Remote workers need an authentication key")
+    self.maxretries = maxretries
+    self.listener = Listener(address, authkey = authkey)
+    self.address = self.listener.address
+    self.workers = []
+    self.busy = {}
+    self.waiting = []
+    self.joined = Queue.Queue()
+    self.closed = False
+    t = threading.Thread(target = self.accept_loop)
+    t.daemon = True
+    t.start()
+
+  def accept_loop(self):
+    ## Runs in a thread of its own, since accept() also authenticates
+    ## the worker, which may take a while.
+    while not self.closed:
+      try:
+        conn = self.listener.accept()
+      except (AuthenticationError, EOFError, IOError):
+        continue
+      self.joined.put(conn)
+
+  def add_joined(self, block = False):
+    ## Start sending requests to workers that have connected.  With
+    ## "block", wait for one if there are no workers at all.
+    while True:
+      try:
+        conn = self.joined.get(block and not self.workers, 1)
+      except Queue.Empty:
+        if block and not self.workers:
+          continue
+        return
+      self.workers.append(conn)
+
+  def drop(self, conn):
+    self.workers.remove(conn)
+    conn.close()
+
+  ## Requests are handed out as in SolverPool: submit() one whenever
+  ## ready() says a worker is free, and collect the answers with
+  ## results().  Workers that connect later get requests as soon as they
+  ## join.
+
+  def ready(self):
+    ## Waits for a worker to connect if there are none at all.
+    self.add_joined(block = True)
+    self.dispatch()
+    return not self.waiting and len(self.busy) < len(self.workers)
+
+  def submit(self, req):
+    self.waiting.append((req, 0))
+    self.dispatch()
+
+  def pending(self):
+    return len(self.waiting) + len(self.busy)
+
+  def dispatch(self):
+    ## Send the requests waiting for a worker to idle ones.  Each comes
+    ## with the number of times it has lost its worker.
+    idle = [c for c in self.workers if c not in self.busy]
+    while self.waiting and idle:
+      c = idle.pop()
+      (req, retries) = self.waiting.pop(0)
+      try:
+        c.send(req)
+      except (EOFError, IOError):
+        self.drop(c)
+        self.waiting.insert(0, (req, retries))
+        continue
+      self.busy[c] = (req, retries)
+
+  def results(self):
+    ## Wait for at least one submitted request to be answered, and
+    ## return the answers that have arrived.  A request that loses its
+    ## worker more than "maxretries" times, such as one that crashes
+    ## every worker it runs on, gets a SolverCrash instance as its
+    ## answer.
+    while True:
+      self.add_joined(block = not self.busy)
+      self.dispatch()
+      ## Look for newly connected workers every second.
+      res = []
+      for c in select.select(self.busy.keys(), [], [], 1)[0]:
+        (req, retries) = self.busy.pop(c)
+        try:
+          res.append(c.recv())
+        except (EOFError, IOError):
+          self.drop(c)
+          if retries >= self.maxretries:
+            res.append(SolverCrash())
+          else:
+            self.waiting.insert(0, (req, retries + 1))
+      if res:
+        return res
+
+  def shutdown(self):
+    self.closed = True
+    self.busy = {}
+    self.waiting = []
+    self.add_joined()
+    for c in list(self.workers):
+      try:
+        c.send(None)
+      except (EOFError, IOError):
+        pass
+      self.drop(c)
+    self.listener.close()
+
+def serve(address, handler, authkey, wait = 60):
+  ## Connect to the coordinator at "address" and answer its requests
+  ## with "handler" until it is done.  Keep trying to connect for
+  ## "wait" seconds, in case the coordinator is not up yet.
+  deadline = time.time() + wait
+  while True:
+    try:
+      conn = Client(address, authkey = authkey)
+      break
+    except socket.error:
+      if time.time() >= deadline:
+        raise
+      time.sleep(1)
+  while True:
+    try:
+      req = conn.recv()
+    except EOFError:
+      break
+    if req is None:
+      break
+    conn.send(handler(req))
+  conn.close()
@@ -0,0 +1,96 @@
+## A persistent cache of solver results, shared across runs.
+##
+## Results are stored in an SQLite file, keyed by a digest of the
+## canonical form of the path condition (see fuzzy.canonical()), so
+## the same query asked in a later run is answered without a solver.
+## The cache holds at most "maxentries" results; when it grows past
+## that, the least recently used ones are evicted.
+
+import sqlite3
+import cPickle
+
+class SolverCache(object):
+  def __init__(self, path, maxentries = 200000, syncevery = 100):
+    self.path = path
+    self.maxentries = maxentries
+    self.syncevery = syncevery
+    self.db = sqlite3.connect(path)
+    self.db.text_factory = str
+    self.db.execute('PRAGMA synchronous = OFF')
+    self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                    '  key TEXT PRIMARY KEY,'
+                    '  ok TEXT NOT NULL,'
+                    '  model BLOB,'
+                    '  constr BLOB,'
+                    '  used INTEGER NOT NULL)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS results_used '
+                    'ON results (used)')
+    (self.nentries, used) = self.db.execute(
+      'SELECT COUNT(*), MAX(used) FROM results').fetchone()
+    self.clock = (used or 0) + 1
+    self.dirty = 0
+    self.hits = 0
+    self.misses = 0
+
+  def tick(self):
+    self.clock += 1
+    self.dirty += 1
+    if self.dirty >= self.syncevery:
+      self.sync()
+    return self.clock
+
+  def get(self, key):
+    ## Return (ok, model) for "key", where "ok" is the string name of
+    ## the solver's answer, or None if the key is not cached.
+    row = self.db.execute('SELECT ok, model FROM results WHERE key = ?',
+                          (key,)).fetchone()
+    if row is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.db.execute('UPDATE results SET used = ? WHERE key = ?',
+                    (self.tick(), key))
+    (ok, model) = row
+    if model is not None:
+      model = cPickle.loads(str(model))
+    return (ok, model)
+
+  def put(self, key, ok, model, constr = None):
+    ## "constr" is the query itself; it is not needed to answer lookups,
+    ## but keeps the cache usable as a corpus of real queries.
+    if model is not None:
+      model = sqlite3.Binary(cPickle.dumps(model, 2))
+    if constr is not None:
+      constr = sqlite3.Binary(cPickle.dumps(constr, 2))
+    self.db.execute('INSERT OR REPLACE INTO results '
+                    '(key, ok, model, constr, used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, ok, model, constr, self.tick()))
+    self.nentries += 1
+    if self.nentries > self.maxentries * 1.1:
+      self.evict()
+
+  def evict(self):
+    (self.nentries,) = self.db.execute(
+      'SELECT COUNT(*) FROM results').fetchone()
+    excess = self.nentries - self.maxentries
+    if excess > 0:
+      self.db.execute('DELETE FROM results WHERE key IN '
+                      '(SELECT key FROM results ORDER BY used LIMIT ?)',
+                      (excess,))
+      self.nentries -= excess
+    self.sync()
+
+  def queries(self):
+    ## Iterate over the cached queries that were stored with a "constr".
+    for (constr,) in self.db.execute('SELECT constr FROM results '
+                                     'WHERE constr IS NOT NULL'):
+      yield cPickle.loads(str(constr))
+
+  def sync(self):
+    self.db.commit()
+    self.dirty = 0
+
+  def close(self):
+    self.sync()
+    self.db.close()
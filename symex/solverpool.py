@@ -0,0 +1,233 @@
+## A pool of long-lived solver processes.
+##
+## z3str keeps lots of state in global variables, so every query used
+## to be solved in a freshly started process.  Starting a process per
+## branch dominates the cost of long runs, so instead we keep a few
+## worker processes around, reset what state we can between queries,
+## and replace a worker after a given number of queries (after every
+## one for z3str, whose state cannot be reset), or whenever it crashes
+## or runs past its timeout.
+##
+## Nothing here is specific to solvers: parallel concolic_test() runs
+## use the same pool to run the test function in several processes.
+
+import multiprocessing
+import select
+import signal
+import time
+
+class SolverTimeout(Exception):
+  pass
+
+class SolverCrash(Exception):
+  pass
+
+def worker_loop(conn, handler, reset):
+  ## Ctrl-C is delivered to the whole process group; leave it to the
+  ## parent, which will shut the pool down.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  while True:
+    try:
+      req = conn.recv()
+    except EOFError:
+      break
+    if req is None:
+      break
+    conn.send(handler(req))
+    if reset is not None:
+      reset()
+  conn.close()
+
+class SolverWorker(object):
+  def __init__(self, handler, reset = None, maxqueries = 0):
+    ## "handler" is called in the worker process for every request and
+    ## returns the (picklable) answer; "reset" is called after each
+    ## request to clear out global solver state.  If "maxqueries" is
+    ## non-zero, the process is replaced after that many requests, to
+    ## bound whatever state "reset" cannot clear.
+    self.handler = handler
+    self.reset = reset
+    self.maxqueries = maxqueries
+    self.proc = None
+    self.conn = None
+    self.nqueries = 0
+    self.retired = []
+    self.start()
+
+  def start(self):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    self.proc = multiprocessing.Process(target=worker_loop,
+                                        args=(child_conn, self.handler,
+                                              self.reset))
+    self.proc.daemon = True
+    self.proc.start()
+    child_conn.close()
+    self.conn = parent_conn
+    self.nqueries = 0
+
+  def stop(self, graceful = True):
+    for p in self.retired:
+      p.join(1)
+      if p.is_alive():
+        p.terminate()
+        p.join()
+    self.retired = []
+    if self.proc is None:
+      return
+    if graceful and self.proc.is_alive():
+      try:
+        self.conn.send(None)
+      except IOError:
+        pass
+      self.proc.join(1)
+    if self.proc.is_alive():
+      self.proc.terminate()
+    self.proc.join()
+    self.conn.close()
+    self.proc = None
+    self.conn = None
+
+  def restart(self):
+    self.stop(graceful = False)
+    self.start()
+
+  def retire(self):
+    ## Replace a worker that has answered "maxqueries" requests as soon
+    ## as it has, rather than when the next request comes in, so that
+    ## the new process starts while the caller deals with the answer.
+    ## The old one is told to exit, and reaped once it has.
+    try:
+      self.conn.send(None)
+    except IOError:
+      pass
+    self.conn.close()
+    self.retired = [p for p in self.retired if p.is_alive()]
+    self.retired.append(self.proc)
+    self.start()
+
+  def submit(self, req):
+    if self.maxqueries and self.nqueries >= self.maxqueries:
+      self.stop()
+      self.start()
+    self.nqueries += 1
+    try:
+      self.conn.send(req)
+    except IOError:
+      ## The worker died while idle; start a new one and try again.
+      self.restart()
+      self.nqueries += 1
+      self.conn.send(req)
+
+  def result(self, timeout = None):
+    ## Wait for the answer to the last submitted request.  On timeout
+    ## or crash, the worker is replaced and an exception is raised.
+    try:
+      if not self.conn.poll(timeout):
+        self.restart()
+        raise SolverTimeout()
+      res = self.conn.recv()
+    except (EOFError, IOError):
+      self.restart()
+      raise SolverCrash()
+    if self.maxqueries and self.nqueries >= self.maxqueries:
+      self.retire()
+    return res
+
+class SolverPool(object):
+  def __init__(self, handler, nworkers = 1, reset = None, maxqueries = 0):
+    self.maxqueries = maxqueries
+    self.workers = [SolverWorker(handler, reset, maxqueries)
+                    for i in range(nworkers)]
+    self.inflight = set()
+
+  def check(self, req, timeout = None):
+    w = self.workers[0]
+    w.submit(req)
+    return w.result(timeout)
+
+  def check_many(self, reqs, timeout = None):
+    ## Spread "reqs" over all workers, yielding (index, result) pairs
+    ## in the order the answers arrive.  A request that times out or
+    ## crashes its worker yields a SolverTimeout or SolverCrash instance
+    ## as its result.  "timeout" is either one timeout for all requests
+    ## or a list with a timeout for each.
+    if isinstance(timeout, list):
+      timeouts = timeout
+    else:
+      timeouts = [timeout] * len(reqs)
+    pending = list(enumerate(reqs))
+    pending.reverse()
+    idle = list(self.workers)
+    busy = {}
+    try:
+      while pending or busy:
+        while pending and idle:
+          w = idle.pop()
+          (i, req) = pending.pop()
+          w.submit(req)
+          deadline = None
+          if timeouts[i] is not None:
+            deadline = time.time() + timeouts[i]
+          busy[w] = (i, deadline)
+
+        wait = None
+        deadlines = [busy[w][1] for w in busy if busy[w][1] is not None]
+        if deadlines:
+          wait = max(0, min(deadlines) - time.time())
+        ready = select.select([w.conn for w in busy], [], [], wait)[0]
+
+        now = time.time()
+        for w in busy.keys():
+          (i, deadline) = busy[w]
+          if w.conn in ready:
+            try:
+              res = w.result(0)
+            except (SolverTimeout, SolverCrash) as e:
+              res = e
+          elif deadline is not None and now >= deadline:
+            w.restart()
+            res = SolverTimeout()
+          else:
+            continue
+          del busy[w]
+          idle.append(w)
+          yield (i, res)
+    finally:
+      ## If the caller stopped early, don't leave stale answers behind.
+      for w in busy:
+        w.restart()
+
+  ## For requests that keep coming while others are being answered:
+  ## submit() one whenever ready() says a worker is free, and collect
+  ## the answers with results().
+
+  def ready(self):
+    return len(self.inflight) < len(self.workers)
+
+  def submit(self, req):
+    w = [w for w in self.workers if w not in self.inflight][0]
+    w.submit(req)
+    self.inflight.add(w)
+
+  def pending(self):
+    return len(self.inflight)
+
+  def results(self):
+    ## Wait for at least one submitted request to be answered, and
+    ## return the answers that have arrived.  A request that crashes
+    ## its worker gets a SolverCrash instance as its answer.
+    conns = dict((w.conn, w) for w in self.inflight)
+    res = []
+    for conn in select.select(conns.keys(), [], [])[0]:
+      w = conns[conn]
+      self.inflight.discard(w)
+      try:
+        res.append(w.result(0))
+      except (SolverTimeout, SolverCrash) as e:
+        res.append(e)
+    return res
+
+  def shutdown(self):
+    self.inflight = set()
+    for w in self.workers:
+      w.stop()
@@ -2,7 +2,10 @@
 
 import sys
 import os
+import shutil
+import multiprocessing.util
 import fuzzy
+from contextlib import contextmanager
 
 # patch Django where needed
 from mock import patch
@@ -133,12 +136,18 @@ import symex.importwrapper as importwrapper
 import symex.rewriter as rewriter
 importwrapper.rewrite_imports(rewriter.rewriter)
 
+# Raised to roll back the transaction around an iteration
+class RollbackIteration(Exception):
+  pass
+
 # It's only safe to use SymDjango as a singleton!
 class SymDjango():
   def __init__(self, settings, path, viewmap):
     self.settings = settings
     self.path = path
     self.viewmap = viewmap
+    self.dbfile = None
+    self.snapshot = None
 
     # search for modules inside application under test
     sys.path.append(path)
@@ -161,6 +170,84 @@ class SymDjango():
   def new(self):
     return SymClient(self, SERVER_NAME='concolic.io')
 
+  def load_fixtures(self, loader, copy=False):
+    # Run loader once to fill the database, and commit what it creates;
+    # clean_db() brings the database back to this state after every
+    # iteration. With copy=True, an SQLite database file is restored
+    # from a copy kept in memory rather than by rolling back.
+    from django.db import connection, transaction
+    with transaction.atomic():
+      loader()
+
+    if copy:
+      name = connection.settings_dict['NAME']
+      if connection.vendor != 'sqlite' or name in ('', ':memory:'):
+        raise Exception("Only SQLite database files can be copied")
+      self.dbfile = name
+    self.close_db()
+    if copy:
+      with open(self.dbfile, 'rb') as f:
+        self.snapshot = f.read()
+
+  def close_db(self):
+    # Connections are reopened on demand; closing them here also keeps
+    # processes forked later from sharing one.
+    from django.db import connections
+    for conn in connections.all():
+      conn.close()
+
+  def private_db(self, tag):
+    # Give this process a database of its own, for running iterations in
+    # several processes side by side (see testinit in concolic_test). An
+    # SQLite database file is copied to a name ending in tag, which is
+    # removed when the process exits; an in-memory database already
+    # belongs to each forked process alone.
+    from django.db import connection
+    name = connection.settings_dict['NAME']
+    if connection.vendor != 'sqlite':
+      raise Exception("Only SQLite databases can be made private")
+    if name in ('', ':memory:'):
+      return
+    self.close_db()
+    private = '%s.%s' % (name, tag)
+    shutil.copyfile(name, private)
+    connection.settings_dict['NAME'] = private
+    if self.dbfile is not None:
+      self.dbfile = private
+
+    # Unlike atexit handlers, multiprocessing finalizers also run when a
+    # pool worker exits, and never in the children it forks.
+    multiprocessing.util.Finalize(None, self.remove_private_db,
+                                  args=(private,), exitpriority=0)
+
+  def remove_private_db(self, private):
+    self.close_db()
+    try:
+      os.remove(private)
+    except OSError:
+      pass
+
+  @contextmanager
+  def clean_db(self):
+    # Run the body of the with statement against the database as
+    # load_fixtures() left it, and undo whatever the body changes.
+    from django.db import transaction
+    if self.snapshot is not None:
+      try:
+        yield
+      finally:
+        self.close_db()
+        with open(self.dbfile, 'wb') as f:
+          f.write(self.snapshot)
+      return
+
+    try:
+      with transaction.atomic():
+        yield
+        raise RollbackIteration()
+    except RollbackIteration:
+      pass
+
 # Mock requests by mocking routing + url parsing
 from django.test.client import Client
 
@@ -362,7 +362,8 @@ class MutationSymQuerySet(AllSymQuerySet, SymMixin):
       return
 
   def _hash_condition(self, condition):
-    return str(condition)
+    ## AST nodes are hash-consed, so they can be used as keys directly.
+    return condition
 
   def _add_to_cache(self, condition):
     return self.condition_cache.add(self._hash_condition(condition))